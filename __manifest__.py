@@ -22,13 +22,15 @@
     'website': "http://diogocduarte.github.io/",
     'category': 'Uncategorized',
     'version': '0.1',
-    'depends': ['base', 'base_setup'],
+    'depends': ['base', 'base_setup', 'web'],
     'auto_install': True,
     'external_dependencies': {
         'python': ['awscli', 'boto3'],
     },
     'data': [
+        'security/ir.model.access.csv',
         'data/filestore_data.xml',
+        'data/ir_cron.xml',
         'views/ir_attachment_views.xml',
         'views/res_config_views.xml'
     ],
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+import werkzeug.exceptions
+import werkzeug.utils
+import werkzeug.wrappers
+
+from odoo import http
+from odoo.http import request
+from odoo.tools import config, consteq
+from odoo.addons.web.controllers.main import Binary
+
+from ..models.ir_attachment import metrics_directory
+from ..tools.metrics import collect, metrics, render
+
+_logger = logging.getLogger(__name__)
+
+
+class S3Binary(Binary):
+    """Streams S3 stored attachments by chunks instead of building the whole
+    base64 payload in the worker."""
+
+    @http.route()
+    def content_common(self, xmlid=None, model='ir.attachment', id=None, field='datas', **kw):
+        response = None
+        if model == 'ir.attachment' and field == 'datas':
+            try:
+                response = self._s3_content(xmlid=xmlid, id=id, **kw)
+            except Exception:
+                _logger.error('S3: content_common was not able to stream (xmlid:%s id:%s), gonna read it',
+                              xmlid, id, exc_info=True)
+        if response is None:
+            return super(S3Binary, self).content_common(xmlid=xmlid, model=model, id=id, field=field, **kw)
+        if kw.get('token'):
+            response.set_cookie('fileToken', kw['token'])
+        return response
+
+    def _s3_attachment(self, xmlid=None, id=None):
+        if xmlid:
+            record = request.env.ref(xmlid, False)
+        elif id:
+            record = request.env['ir.attachment'].browse(int(id))
+        else:
+            return None
+        if not record or record._name != 'ir.attachment':
+            return None
+        attachment = record.sudo()
+        if not attachment.exists() or attachment.type != 'binary' \
+                or not attachment.store_fname or not attachment.mimetype:
+            return None
+        return attachment
+
+    def _s3_content(self, xmlid=None, id=None, filename=None, filename_field='datas_fname', unique=None,
+                    mimetype=None, download=None, **kw):
+        """Return a redirection to S3 or a streamed response for an S3 stored
+        attachment, or None to let the standard controller handle the request."""
+        attachment = self._s3_attachment(xmlid=xmlid, id=id)
+        if attachment is None or attachment._storage()[:5] != 's3://':
+            return None
+
+        # access rights, etag and headers without loading the content
+        env = request.env(context=dict(request.env.context, bin_size=True))
+        status, headers, content = request.registry['ir.http'].binary_content(
+            xmlid=xmlid, model='ir.attachment', id=id, field='datas', unique=unique, filename=filename,
+            filename_field=filename_field, download=download, mimetype=mimetype, env=env)
+        if status == 304:
+            return werkzeug.wrappers.Response(status=status, headers=headers)
+        elif status != 200:
+            return None
+
+        if attachment._s3_serve_mode() == 'redirect':
+            try:
+                presigned = attachment._s3_presigned_url(
+                    content_type=dict(headers).get('Content-Type'),
+                    content_disposition=dict(headers).get('Content-Disposition'))
+            except Exception:
+                _logger.error('S3: was not able to presign the url of attachment %s, gonna stream it',
+                              attachment.id, exc_info=True)
+                presigned = None
+            if presigned:
+                url, max_age = presigned
+                response = werkzeug.utils.redirect(url, code=302)
+                response.headers['Cache-Control'] = 'private, max-age=%d' % max_age
+                return response
+
+        byte_range = None
+        httprequest = request.httprequest
+        if httprequest.range and len(httprequest.range.ranges) == 1:
+            if_range = httprequest.headers.get('If-Range')
+            if not if_range or if_range == dict(headers).get('ETag'):
+                byte_range = httprequest.headers.get('Range')
+
+        stream = attachment._s3_stream(byte_range=byte_range)
+        if stream is None:
+            return None
+
+        headers.append(('Accept-Ranges', 'bytes'))
+        headers.append(('Content-Length', stream['length']))
+        if stream['content_range']:
+            status = 206
+            headers.append(('Content-Range', stream['content_range']))
+        return werkzeug.wrappers.Response(stream['chunks'], status=status, headers=headers, direct_passthrough=True)
+
+
+class S3Metrics(http.Controller):
+
+    @http.route('/s3/metrics', type='http', auth='none')
+    def s3_metrics(self, token=None, **kw):
+        """Metrics of all the workers in the Prometheus text format, for the
+        bearer of the s3_metrics_token of the server configuration file."""
+        expected = config.get('s3_metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[7:]
+        if not expected or not token or not consteq(str(expected), str(token)):
+            raise werkzeug.exceptions.NotFound()
+        directory = metrics_directory()
+        metrics.flush(directory, force=True)
+        return request.make_response(render(collect(directory)), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Cache-Control', 'no-store'),
+        ])
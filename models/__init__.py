@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from . import ir_attachment
+from . import ir_attachment_s3_checklist
 from . import ir_autovacuum
+from . import ir_http
 from . import res_config
@@ -2,32 +2,120 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 from odoo import api, models, fields
+from odoo.tools import config, human_size
 
-import boto3
-import botocore
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from concurrent import futures
+from dateutil.tz import tzutc
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
 import base64
+import datetime
+import itertools
+import json
 import logging
+import numbers
+import random
 import re
 import os
+import threading
+import time
+
+try:
+    # wraps the string without copying it
+    from cStringIO import StringIO as BufferIO
+except ImportError:
+    from io import BytesIO as BufferIO
+try:
+    from urlparse import parse_qsl
+except ImportError:
+    from urllib.parse import parse_qsl
+
+from ..tools import compression
+from ..tools.backends import Backends, ThreadedBackend, is_missing
+from ..tools.batch import DELETE_BATCH_SIZE, delete_keys, transfer_keys
+from ..tools.breaker import CircuitOpen
+from ..tools.diskcache import get_cache
+from ..tools.integrity import CorruptObject, check_upload, content_md5, expected_sha1, iter_verified, sha1_of, verify
+from ..tools.layout import DEFAULT_TIER, get_layout, split_location
+from ..tools.listing import KeyIndex, iter_files, iter_objects
+from ..tools.metrics import metrics
+from ..tools.migrate import FilestoreMigration
+from ..tools.registry import s3_registry, DEFAULT_OPTIONS
+from ..tools.report import AuditStatus, ReportWriter
+from ..tools.staging import Staging
+from ..tools.streams import iter_body
+from ..tools.sync import BucketToBucket, BucketToFilestore
+from ..tools.throttle import RateLimiter
 
 _logger = logging.getLogger(__name__)
 
+# check_s3_filestore lists the bucket from this number of attachments on
+LISTING_AUDIT_MIN_RECORDS = 1000
+AUDIT_FETCH_SIZE = 10000
+# staged files not referenced after this many seconds are dropped
+STAGING_GRACE = 24 * 3600
+STAGING_BATCH_SIZE = 100
+# advisory locks of the garbage collection: (GC_LOCK, shard), -1 for the bucket checklist
+GC_LOCK = 0x53334743
+GC_RETRY_DELAY = '1 hour'
+# seconds before a marked file is collected, see _s3_gc_grace
+GC_GRACE = 24 * 3600
+# files looked at by each query of the tiering
+TIERING_BATCH_SIZE = 1000
+# objects listed at once by the scrubber, its position is saved after each batch
+SCRUB_BATCH_SIZE = 1000
+
+
+def _registry_options():
+    """Connection pool settings for this process, read from the server
+    configuration file (s3_max_pool_connections, s3_max_attempts,
+    s3_connect_timeout, s3_read_timeout, s3_bucket_check_ttl, ...) and
+    s3_endpoint_url for an S3 compatible service."""
+    options = dict((name, int(config.get('s3_%s' % name) or default))
+                   for name, default in DEFAULT_OPTIONS.items())
+    options['endpoint_url'] = config.get('s3_endpoint_url') or None
+    return options
+
+
+def metrics_directory():
+    """Directory where the workers share their metrics, s3_metrics_dir in the
+    server configuration file (<data_dir>/s3_metrics by default)."""
+    return config.get('s3_metrics_dir') or os.path.join(config['data_dir'], 's3_metrics')
+
+
+def _add_stats(total, stats):
+    """Add the statistics of a transfer to ``total``, its throughput being
+    the one of all the transfers."""
+    for name, value in stats.items():
+        if name != 'bytes_per_second':
+            total[name] = total.get(name, 0) + value
+    total['bytes_per_second'] = total.get('bytes', 0) / max(total.get('seconds', 0), 0.001)
+    return total
+
 
 class S3Attachment(models.Model):
     """Extends ir.attachment to implement the S3 storage engine
     """
     _inherit = "ir.attachment"
-    _s3_bucket = False
 
     s3_key = fields.Char('S3 Key', index=True)
     s3_url = fields.Char('S3 Url', index=True, size=1024)
     s3_lost = fields.Boolean('S3 Not Found')
+    s3_corrupt = fields.Boolean('S3 Corrupt', help="The S3 object does not match the checksum of the file, "
+                                                   "it is uploaded again by the next write of the same content")
+    s3_tier = fields.Char('S3 Tier', index=True, help="Tier of ir_attachment.s3_tiers holding the file, "
+                                                       "empty for the default one")
+    # the garbage collection looks for the references of the files it checks
+    store_fname = fields.Char(index=True)
 
     def _parse_storage_url(self, bucket_url):
         scheme = bucket_url[:5]
         assert scheme == 's3://', \
             "Expecting an s3:// scheme, got {} instead.".format(scheme)
+        # s3://profile:<name>@<bucket>?endpoint=<url> for an S3 compatible service
+        bucket_url, sep, query = bucket_url.partition('?')
+        endpoint_url = dict(parse_qsl(query)).get('endpoint')
         try:
             remain = bucket_url.lstrip(scheme)
             access_type = remain.split(':')[0]
@@ -40,28 +128,67 @@ class S3Attachment(models.Model):
                     " Unable to establish a connexion to S3.")
         except Exception:
             raise Exception("Unable to parse the S3 bucket url.")
-        return scheme, access_type, profile_name, bucket_name
+        return scheme, access_type, profile_name, bucket_name, endpoint_url
 
-    def _connect_to_S3_bucket(self, bucket_url):
-        scheme, access_type, profile_name, bucket_name = self._parse_storage_url(bucket_url)
-        if access_type == 'profile':
-            session = boto3.session.Session(profile_name=profile_name)
-            s3_conn = session.resource('s3')
+    def _s3_connection(self, bucket_url, force_check=False):
+        """Return the pooled connection of this process for the storage url,
+        making sure the bucket was validated recently."""
+        connection = s3_registry.get(self._parse_storage_url(bucket_url), _registry_options())
+        if not connection.breaker.allow() and not force_check:
+            # S3 is failing: do not wait for its timeouts, the callers fall back
+            raise CircuitOpen('S3 circuit breaker open for %s' % connection.bucket_name)
+        connection.ensure_bucket(force=force_check)
+        return connection
 
-        # Get bucket or create one
-        s3_bucket = s3_conn.Bucket(bucket_name)
-        exists = True
-        try:
-            s3_conn.meta.client.head_bucket(Bucket=bucket_name)
-        except botocore.exceptions.ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                exists = False
+    def _s3_is_missing(self, error):
+        """Tell whether ``error`` means that the object does not exist, rather
+        than S3 failing."""
+        if isinstance(error, KeyError):
+            # known to be missing, see S3Connection.missing_keys
+            return True
+        return is_missing(error)
+
+    def _connect_to_S3_bucket(self, bucket_url, force_check=False):
+        return self._s3_connection(bucket_url, force_check=force_check).bucket
+
+    @api.model
+    def _s3_layout(self):
+        """Buckets and tiers of the storage (see tools/layout.py): the default
+        tier is ir_attachment.location, the others and the rules placing the
+        files in them come from the json of ir_attachment.s3_tiers."""
+        return get_layout(self._storage(), self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_tiers'))
+
+    def _s3_connection_for(self, fname, tier=None, force_check=False):
+        """Return the connection of the bucket holding ``fname`` in ``tier``."""
+        return self._s3_connection(self._s3_layout().url_for(fname, tier), force_check=force_check)
 
-        if not exists:
-            s3_bucket.create_bucket(Bucket=bucket_name)
+    @api.model
+    def _s3_file_tier(self, fname):
+        """Tier holding ``fname``: the one of the attachments referencing it."""
+        if not self._s3_layout().tiered:
+            return None
+        attachments = self.filtered(lambda a: a.store_fname == fname)
+        if attachments:
+            return attachments[0].s3_tier
+        self._cr.execute("SELECT s3_tier FROM ir_attachment WHERE store_fname = %s ORDER BY s3_tier LIMIT 1",
+                         [fname])
+        row = self._cr.fetchone()
+        return row and row[0]
 
-        return s3_bucket
+    @api.multi
+    def _s3_tier_for_write(self, fname, size):
+        """Tier where ``fname`` is written: the one already holding the same
+        content, else the tier given by the rules for the attachment."""
+        layout = self._s3_layout()
+        if not layout.tiered:
+            return None
+        self._cr.execute("""SELECT s3_tier FROM ir_attachment
+                            WHERE store_fname = %s AND s3_lost IS NOT TRUE LIMIT 1""", [fname])
+        row = self._cr.fetchone()
+        if row:
+            return row[0] or DEFAULT_TIER
+        attachment = self[:1]
+        return layout.tier_for(attachment.res_model, attachment.mimetype, size)
 
     def _s3_key_from_fname(self, store_fname):
         db_name = self.env.registry.db_name
@@ -81,49 +208,85 @@ class S3Attachment(models.Model):
         storage = self._storage()
         r = ''
         if storage[:5] == 's3://':
+            staged = self._s3_read_staged(fname, bin_size)
+            if staged is not None:
+                metrics.incr('s3_reads_total', outcome='staged')
+                return staged
+            # the file can be shared by several attachments, it is read once for all of them
+            attachments = self.filtered(lambda a: a.store_fname == fname)
             try:
-                if not self._s3_bucket:
-                    self._s3_bucket = self._connect_to_S3_bucket(storage)
+                connection = self._s3_connection_for(fname, attachments._s3_file_tier(fname))
+                s3_bucket = connection.bucket
             except Exception:
                 _logger.error('S3: _file_read Was not able to connect (%s), gonna try other filestore', storage)
+                metrics.incr('s3_reads_total', outcome='fallback')
                 return super(S3Attachment, self)._file_read(fname=fname, bin_size=bin_size)
 
-            # It's not a @multi but i always use a for instead of an if exists because makes it easy to switch to multi
-            for attachment in self:
-                key = self._s3_key_from_fname(fname)
-                try:
-                    # Try reading this key
-                    s3_key = self._s3_bucket.Object(key)
-                    r = base64.b64encode(s3_key.get()['Body'].read())
-                    # Set the field s3_key on the attachment, if not there already
-                    if not attachment.s3_key:
-                        attachment.s3_key = s3_key.key
-                        attachment.s3_url = '%s/%s/%s' % (
-                            s3_key.meta.client.meta.endpoint_url, s3_key.bucket_name, s3_key.key)
-                        _logger.debug('S3: _file_read updated s3_url for key:%s', key)
-
-                    _logger.debug('S3: _file_read read key:%s from bucket successfully', key)
+            key = self._s3_key_from_fname(fname)
+            trash_key = self._s3_trash_key(fname)
+            try:
+                # Try reading this key
+                if key in connection.missing_keys:
+                    raise KeyError(key)
+                s3_key = s3_bucket.Object(key)
+                r = self._s3_read_object(s3_key, bin_size, fname=fname)
+                # Set the field s3_key on the attachments, if not there already
+                unkeyed = attachments.filtered(lambda a: not a.s3_key)
+                if unkeyed:
+                    unkeyed.write({
+                        's3_key': s3_key.key,
+                        's3_url': '%s/%s/%s' % (s3_key.meta.client.meta.endpoint_url, s3_key.bucket_name, s3_key.key),
+                    })
+                    _logger.debug('S3: _file_read updated s3_url for key:%s', key)
 
-                except Exception:
-                    _logger.error('S3: _file_read was not able to read from S3 or other filestore key:%s', key)
-                    # Check the trash
-                    try:
-                        trash_key_list = key.split('/')
-                        trash_key_list.insert(1, 'trash')
-                        trash_key = '/'.join(trash_key_list)
-                        # Try reading trash key
-                        s3_trash_key = self._s3_bucket.Object(trash_key)
-                        r = base64.b64encode(s3_trash_key.get()['Body'].read())
-                        _logger.debug('S3: _file_read read key:%s from bucket trash bin', s3_trash_key)
-                        # Restore the file
-                        self._s3_bucket.Object(key).copy_from(CopySource='%s/%s' % (s3_trash_key.bucket_name, s3_trash_key.key))
-                        s3_trash_key.delete()
-                        _logger.debug('S3: _file_read --::-- restored the key:%s from bucket trash bin key %s', s3_trash_key.key, key)
+                metrics.incr('s3_reads_total', outcome='hit')
+                _logger.debug('S3: _file_read read key:%s from bucket successfully', key)
 
-                    except Exception:
-                        _logger.error('S3: _file_read also not able to find in trash the key:%s', key)
+            except CorruptObject as ex:
+                # the object is there but its content is wrong: never hand it out
+                _logger.error('S3: _file_read key:%s is corrupt: %s', key, ex)
+                connection.known_keys.discard(key)
+                metrics.incr('s3_reads_total', outcome='corrupt')
+                if attachments:
+                    attachments.write({'s3_corrupt': True})
+                if not self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to', False):
+                    r = super(S3Attachment, self)._file_read(fname, bin_size=bin_size)
+                return r
+            except Exception as ex:
+                if not self._s3_is_missing(ex):
+                    # S3 is failing, the file is not lost
+                    _logger.error('S3: _file_read was not able to read key:%s: %s', key, ex)
+                    metrics.incr('s3_reads_total', outcome='fallback')
+                    if not self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to', False):
+                        r = super(S3Attachment, self)._file_read(fname, bin_size=bin_size)
+                    return r
+                _logger.error('S3: _file_read was not able to read from S3 or other filestore key:%s', key)
+                connection.missing_keys.add(key)
+                # Check the trash
+                try:
+                    # Try reading trash key
+                    if trash_key in connection.missing_keys:
+                        raise KeyError(trash_key)
+                    s3_trash_key = s3_bucket.Object(trash_key)
+                    r = self._s3_read_object(s3_trash_key, bin_size, cache_key=key, fname=fname)
+                    _logger.debug('S3: _file_read read key:%s from bucket trash bin', s3_trash_key)
+                    # Restore the file
+                    s3_bucket.Object(key).copy_from(CopySource='%s/%s' % (s3_trash_key.bucket_name, s3_trash_key.key))
+                    s3_trash_key.delete()
+                    connection.stored(key)
+                    connection.missing_keys.add(trash_key)
+                    metrics.incr('s3_reads_total', outcome='trash_restore')
+                    _logger.debug('S3: _file_read --::-- restored the key:%s from bucket trash bin key %s', s3_trash_key.key, key)
 
-                    attachment.s3_lost = True
+                except Exception as ex:
+                    _logger.error('S3: _file_read also not able to find in trash the key:%s', key)
+                    if self._s3_is_missing(ex):
+                        connection.missing_keys.add(trash_key)
+                        metrics.incr('s3_reads_total', outcome='lost')
+                        if attachments:
+                            attachments.write({'s3_lost': True})
+                    else:
+                        metrics.incr('s3_reads_total', outcome='fallback')
                     # Only try filesystem if the not copied to S3
                     if not self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to', False):
                         r = super(S3Attachment, self)._file_read(fname, bin_size=bin_size)
@@ -132,42 +295,509 @@ class S3Attachment(models.Model):
             r = super(S3Attachment, self)._file_read(fname, bin_size=bin_size)
         return r
 
+    @api.depends('store_fname', 'db_datas')
+    def _compute_datas(self):
+        # several attachments read at once (kanban views, reports, ...) get
+        # their S3 objects fetched concurrently
+        fetched = {}
+        if len(self) > 1 and not self._context.get('bin_size'):
+            fetched = self._s3_fetch_many()
+        if not fetched:
+            return super(S3Attachment, self)._compute_datas()
+        rest_ids = []
+        for attach in self:
+            if attach.store_fname in fetched:
+                attach.datas = fetched[attach.store_fname]
+            else:
+                rest_ids.append(attach.id)
+        if rest_ids:
+            super(S3Attachment, self.browse(rest_ids))._compute_datas()
+
+    @api.multi
+    def _s3_prefetch_datas(self):
+        """Load the datas of the attachments in the ORM cache, fetching their S3
+        objects concurrently."""
+        fetched = self._s3_fetch_many()
+        for attach in self:
+            if attach.store_fname in fetched:
+                attach._cache['datas'] = fetched[attach.store_fname]
+
+    @api.multi
+    def _s3_fetch_many(self):
+        """Fetch the S3 objects of the attachments with the batch backend.
+
+        At most ir_attachment.s3_prefetch_workers requests and
+        ir_attachment.s3_prefetch_max_bytes bytes are in flight. The objects
+        that cannot be fetched are left to _file_read, which knows what to do.
+
+        :return: dict of the base64 content by store_fname
+        """
+        storage = self._storage()
+        if storage[:5] != 's3://':
+            return {}
+        sizes = dict((attach.store_fname, attach.file_size) for attach in self if attach.store_fname)
+        if not sizes:
+            return {}
+
+        result = {}
+        total = len(sizes)
+        cache = self._s3_cache()
+        if cache:
+            for fname in list(sizes):
+                data = cache.get(self._s3_key_from_fname(fname))
+                if data is not None:
+                    result[fname] = base64.b64encode(data)
+                    del sizes[fname]
+
+        if not sizes:
+            return result
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_bytes = int(get_param('ir_attachment.s3_prefetch_max_bytes', 64 * 1024 * 1024))
+        verify_reads = self._s3_verify_reads()
+        workers = min(int(get_param('ir_attachment.s3_prefetch_workers', 8)), len(sizes))
+        # the objects are fetched bucket by bucket
+        layout = self._s3_layout()
+        by_url = {}
+        for attach in self:
+            if attach.store_fname in sizes:
+                by_url.setdefault(layout.url_for(attach.store_fname, attach.s3_tier), {})[
+                    self._s3_key_from_fname(attach.store_fname)] = attach.store_fname
+        for url, key_fnames in by_url.items():
+            try:
+                connection = self._s3_connection(url)
+            except Exception:
+                _logger.error('S3: _s3_fetch_many was not able to connect (%s)', url)
+                continue
+            with ThreadedBackend(connection, workers) as backend:
+                fetched = backend.get_many(key_fnames, dict((key, sizes[fname]) for key, fname in key_fnames.items()),
+                                           max_bytes)
+            for key, response in fetched.items():
+                if isinstance(response, Exception):
+                    _logger.debug('S3: _s3_fetch_many was not able to fetch %s: %s', key_fnames[key], response)
+                    continue
+                data = compression.decode(*response)
+                if verify_reads:
+                    try:
+                        verify(data, key_fnames[key])
+                    except CorruptObject as ex:
+                        _logger.debug('S3: _s3_fetch_many fetched a corrupt object: %s', ex)
+                        continue
+                if cache:
+                    cache.put(key, data)
+                result[key_fnames[key]] = base64.b64encode(data)
+        _logger.debug('S3: _s3_fetch_many fetched %d of %d objects', len(result), total)
+        return result
+
+    @api.model
+    def _s3_cache(self):
+        """Return the local read-through cache, or None when disabled.
+
+        Enabled by a positive ir_attachment.s3_cache_size (bytes), also capped
+        to ir_attachment.s3_cache_entries entries and stored in
+        ir_attachment.s3_cache_dir (<data_dir>/s3_cache by default).
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_size = int(get_param('ir_attachment.s3_cache_size', 0))
+        if max_size <= 0:
+            return None
+        directory = get_param('ir_attachment.s3_cache_dir') or os.path.join(config['data_dir'], 's3_cache')
+        return get_cache(directory, max_size, int(get_param('ir_attachment.s3_cache_entries', 100000)))
+
+    @api.model
+    def _s3_verify_reads(self):
+        """Whether the content read from S3 is checked against the SHA1 of its
+        file name before being used (ir_attachment.s3_verify_reads, 1 or 0)."""
+        return bool(int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_verify_reads', 1)))
+
+    def _s3_read_object(self, s3_object, bin_size=False, cache_key=None, fname=None):
+        cache = self._s3_cache()
+        cache_key = cache_key or s3_object.key
+        if bin_size:
+            # answered from the cache or the object metadata (HEAD), the body is not downloaded
+            path = cache and cache.get_path(cache_key)
+            if path:
+                try:
+                    return human_size(os.path.getsize(path))
+                except OSError:
+                    pass
+            raw_size = s3_object.metadata.get('raw-size')
+            return human_size(int(raw_size) if raw_size else s3_object.content_length)
+        data = cache and cache.get(cache_key)
+        if data is None:
+            response = s3_object.get()
+            data = compression.decode(response['Body'].read(), response.get('Metadata'))
+            if fname and self._s3_verify_reads():
+                verify(data, fname)
+            if cache:
+                cache.put(cache_key, data)
+        return base64.b64encode(data)
+
+    @api.model
+    def _s3_serve_mode(self):
+        """How /web/content serves S3 attachments (ir_attachment.s3_serve_mode):
+        'stream' sends the object through the worker, 'redirect' redirects the
+        browser to a presigned url of the object."""
+        return self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_serve_mode', 'stream')
+
+    @api.multi
+    def _s3_presigned_url(self, content_type=None, content_disposition=None):
+        """Return a presigned url to download the attachment straight from S3,
+        valid ir_attachment.s3_presign_expiry seconds (3600), and for how long
+        it can be cached, or None if the attachment is not known to be stored
+        in S3, or was found lost or corrupt there."""
+        self.ensure_one()
+        storage = self._storage()
+        if storage[:5] != 's3://' or not self.store_fname or not self.s3_key or self.s3_lost or self.s3_corrupt \
+                or self._s3_staging().get_path(self.store_fname):
+            return None
+        expiry = int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_presign_expiry', 3600))
+        params = {}
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if content_disposition:
+            params['ResponseContentDisposition'] = content_disposition
+        connection = self._s3_connection_for(self.store_fname, self.s3_tier)
+        key = self._s3_key_from_fname(self.store_fname)
+        if compression.is_compressible(self.mimetype):
+            # a compressed object must be decoded by the browser
+            codec = connection.presigned_urls.codec(key)
+            if codec == 'gzip':
+                params['ResponseContentEncoding'] = 'gzip'
+            elif codec:
+                return None
+        return connection.presigned_urls.get(key, expiry, **params)
+
+    @api.multi
+    def _s3_stream(self, byte_range=None):
+        """Open the S3 object of the attachment for streaming, without loading
+        its content in memory.
+
+        :param byte_range: value of an HTTP ``Range`` header (single range), if any
+        :return: a dict with the ``chunks`` iterator, the ``length`` of the
+                 returned content and its ``content_range`` (None for the whole
+                 object), or None if the attachment is not stored in S3 or was
+                 found lost or corrupt there
+        """
+        self.ensure_one()
+        storage = self._storage()
+        if storage[:5] != 's3://' or not self.store_fname or not self.s3_key or self.s3_lost or self.s3_corrupt \
+                or self._s3_staging().get_path(self.store_fname):
+            return None
+        key = self._s3_key_from_fname(self.store_fname)
+        cache = self._s3_cache()
+        path = cache and not byte_range and cache.get_path(key)
+        if path:
+            try:
+                cached_file = open(path, 'rb')
+            except (IOError, OSError):
+                pass
+            else:
+                _logger.debug('S3: _s3_stream streaming key:%s from the cache', key)
+                return {
+                    'chunks': iter_body(cached_file),
+                    'length': os.fstat(cached_file.fileno()).st_size,
+                    'content_range': None,
+                }
+        connection = self._s3_connection_for(self.store_fname, self.s3_tier)
+        if key in connection.missing_keys:
+            return None
+        s3_key = connection.bucket.Object(key)
+        try:
+            try:
+                response = s3_key.get(Range=byte_range) if byte_range else s3_key.get()
+            except ClientError as ex:
+                if ex.response['Error']['Code'] != 'InvalidRange':
+                    raise
+                # unsatisfiable range, answer with the whole content instead
+                response = s3_key.get()
+        except ClientError as ex:
+            if not self._s3_is_missing(ex):
+                raise
+            # e.g. a file still on the filesystem only, read by _file_read
+            _logger.debug('S3: _s3_stream key:%s is not in the bucket', key)
+            connection.missing_keys.add(key)
+            return None
+        codec = response.get('Metadata', {}).get('codec')
+        if codec:
+            # ranges of a compressed object make no sense, send it whole
+            if byte_range:
+                response['Body'].close()
+                response = s3_key.get()
+            _logger.debug('S3: _s3_stream streaming key:%s decompressed from %s', s3_key.key, codec)
+            return {
+                'chunks': self._s3_verified(compression.iter_decompress(iter_body(response['Body']), codec)),
+                'length': int(response['Metadata']['raw-size']),
+                'content_range': None,
+            }
+        _logger.debug('S3: _s3_stream streaming key:%s (range:%s)', s3_key.key, byte_range)
+        content_range = response.get('ContentRange') if byte_range else None
+        chunks = iter_body(response['Body'])
+        return {
+            'chunks': chunks if content_range else self._s3_verified(chunks),
+            'length': response['ContentLength'],
+            'content_range': content_range,
+        }
+
+    @api.multi
+    def _s3_verified(self, chunks):
+        """Hash the whole content of the attachment while it is streamed: the
+        response is already under way, so a mismatch flags the attachment and
+        breaks the stream after its last chunk instead of being answered."""
+        if not self._s3_verify_reads():
+            return chunks
+        return self._s3_iter_verified(chunks, self.store_fname)
+
+    def _s3_iter_verified(self, chunks, fname):
+        try:
+            for chunk in iter_verified(chunks, fname):
+                yield chunk
+        except CorruptObject as ex:
+            _logger.error('S3: _s3_stream streamed a corrupt object: %s', ex)
+            metrics.incr('s3_reads_total', outcome='corrupt')
+            # the streaming outlives the request cursor
+            with self.pool.cursor() as cr:
+                cr.execute("UPDATE ir_attachment SET s3_corrupt = true WHERE store_fname = %s", [fname])
+            raise
+
+    @api.model
+    def _s3_transfer_config(self):
+        """Multipart settings for large uploads, from the system parameters
+        ir_attachment.s3_multipart_threshold, ir_attachment.s3_multipart_chunksize
+        (both in bytes) and ir_attachment.s3_multipart_concurrency."""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        concurrency = int(get_param('ir_attachment.s3_multipart_concurrency', 10))
+        return TransferConfig(
+            multipart_threshold=int(get_param('ir_attachment.s3_multipart_threshold', 16 * 1024 * 1024)),
+            multipart_chunksize=int(get_param('ir_attachment.s3_multipart_chunksize', 8 * 1024 * 1024)),
+            # the parts share the connection pool of the process
+            max_concurrency=max(1, min(concurrency, _registry_options()['max_pool_connections'])),
+        )
+
+    @api.model
+    def _s3_encode(self, bin_value, mimetype, metadata):
+        """Return the body to store for ``bin_value`` and its metadata.
+
+        With ir_attachment.s3_compress set to gzip or zstd, content of a
+        compressible mimetype and of at least ir_attachment.s3_compress_min_size
+        bytes (1024) is compressed, if that saves a tenth of its size at least.
+        The codec and the original size are recorded in the metadata.
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        codec = get_param('ir_attachment.s3_compress', '')
+        if not codec or len(bin_value) < int(get_param('ir_attachment.s3_compress_min_size', 1024)) \
+                or not compression.is_compressible(mimetype):
+            return bin_value, metadata
+        if not compression.available(codec):
+            _logger.warning('S3: codec %s is not available, using gzip', codec)
+            codec = 'gzip'
+        body = compression.compress(bin_value, codec)
+        if len(body) > len(bin_value) * 0.9:
+            return bin_value, metadata
+        return body, dict(metadata, **{'codec': codec, 'raw-size': str(len(bin_value))})
+
+    @api.model
+    def _s3_upload(self, s3_key, bin_value, metadata, transfer_config=None):
+        """Upload ``bin_value`` to ``s3_key``, in parallel parts above the
+        multipart threshold.
+
+        Each part is retried on its own by botocore and the multipart upload
+        is aborted by the transfer manager if it finally fails. The size of the
+        object is checked once complete, as there is no Content-MD5 of the
+        whole object.
+        """
+        transfer_config = transfer_config or self._s3_transfer_config()
+        if len(bin_value) < transfer_config.multipart_threshold:
+            # S3 rejects the upload if the body is altered on its way
+            s3_key.put(Body=bin_value, Metadata=metadata, ContentMD5=content_md5(bin_value))
+            return
+        _logger.debug('S3: _s3_upload multipart upload of key:%s (%d bytes)', s3_key.key, len(bin_value))
+        s3_key.upload_fileobj(BufferIO(bin_value), ExtraArgs={'Metadata': metadata}, Config=transfer_config)
+        check_upload(s3_key.meta.client, s3_key.bucket_name, s3_key.key, len(bin_value))
+
+    @api.model
+    def _s3_abort_incomplete_uploads(self, max_age_hours=24):
+        """Abort the multipart uploads of this database left behind by killed
+        workers, so their parts stop being billed."""
+        storage = self._storage()
+        if storage[:5] != 's3://':
+            return 0
+        limit = datetime.datetime.utcnow() - datetime.timedelta(hours=max_age_hours)
+        aborted = 0
+        for url in self._s3_layout().urls():
+            connection = self._s3_connection(url)
+            paginator = connection.client.get_paginator('list_multipart_uploads')
+            for page in paginator.paginate(Bucket=connection.bucket_name, Prefix=self._s3_key_from_fname('')):
+                for upload in page.get('Uploads', []):
+                    if upload['Initiated'].replace(tzinfo=None) > limit:
+                        continue
+                    connection.client.abort_multipart_upload(
+                        Bucket=connection.bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+                    aborted += 1
+        if aborted:
+            _logger.info('S3: aborted %d incomplete multipart uploads', aborted)
+        return aborted
+
+    @api.model
+    def _s3_key_exists(self, connection, key, fname, remote=True):
+        """Tell whether ``key`` is already stored, looking in order at the keys
+        known by this process, at the attachments of the database and finally,
+        if ``remote``, at the bucket itself (HEAD). A corrupt object does not
+        count, so that it is replaced."""
+        if key in connection.known_keys:
+            return True
+        self._cr.execute("""SELECT s3_corrupt IS TRUE FROM ir_attachment
+                            WHERE s3_key = %s AND store_fname = %s AND s3_lost IS NOT TRUE
+                            ORDER BY s3_corrupt IS TRUE DESC
+                            LIMIT 1""", [key, fname])
+        row = self._cr.fetchone()
+        if row and row[0]:
+            return False
+        if not row:
+            if not remote:
+                return False
+            try:
+                connection.client.head_object(Bucket=connection.bucket_name, Key=key)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    return False
+                raise
+        connection.stored(key)
+        return True
+
+    @api.model
+    def _s3_clear_corrupt(self, fname):
+        """The object of ``fname`` was replaced by a good copy."""
+        self._cr.execute("UPDATE ir_attachment SET s3_corrupt = false WHERE store_fname = %s AND s3_corrupt", [fname])
+        self.invalidate_cache(['s3_corrupt'])
+
+    @api.model
+    def _s3_stats(self):
+        """Counters of the S3 connections and of the local cache of this process
+        for the current storage, summed over its buckets (a breaker state is
+        the first one that is not closed)."""
+        storage = self._storage()
+        if storage[:5] != 's3://':
+            return {}
+        stats = {}
+        for url in self._s3_layout().urls():
+            connection = s3_registry.get(self._parse_storage_url(url), _registry_options())
+            values = connection.stats.snapshot()
+            values.update(('breaker_%s' % name, value) for name, value in connection.breaker.snapshot().items())
+            values['missing_keys'] = len(connection.missing_keys)
+            for name, value in values.items():
+                if isinstance(value, numbers.Number):
+                    stats[name] = stats.get(name, 0) + value
+                elif stats.get(name, 'closed') == 'closed':
+                    stats[name] = value
+        cache = self._s3_cache()
+        if cache:
+            stats.update(('cache_%s' % name, value) for name, value in cache.stats.snapshot().items())
+        return stats
+
     @api.multi
     def _file_write(self, value, checksum):
         storage = self._storage()
         if storage[:5] == 's3://':
+            bin_value = value.decode('base64')
+            fname, full_path = self._get_path(bin_value, checksum)
+            key = self._get_s3_key(bin_value, checksum)
+            tier = None
             try:
-                if not self._s3_bucket:
-                    self._s3_bucket = self._connect_to_S3_bucket(storage)
+                tier = self._s3_tier_for_write(fname, len(bin_value))
+                connection = self._s3_connection_for(fname, tier)
+                s3_bucket = connection.bucket
             except Exception:
+                if self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to', False):
+                    # the filestore is not read anymore, the staging cron uploads the file once S3 is back
+                    _logger.error('S3: _file_write was not able to connect (%s), staging key:%s', storage, key)
+                    try:
+                        self._s3_staging().put(fname, bin_value, {})
+                    except Exception:
+                        _logger.error('S3: _file_write was not able to stage key:%s either', key, exc_info=True)
+                        raise Exception('The file %s could not be written to S3 nor staged.' % fname)
+                    metrics.incr('s3_writes_total', outcome='staged')
+                    self._s3_clear_corrupt(fname)
+                    for attachment in self:
+                        attachment.s3_key = key
+                        if tier:
+                            attachment.s3_tier = tier
+                    return fname
                 _logger.error('S3: _file_write was not able to connect (%s), gonna try other filestore', storage)
+                metrics.incr('s3_writes_total', outcome='fallback')
                 return super(S3Attachment, self)._file_write(value, checksum)
 
-            for attachment in self:
-                bin_value = value.decode('base64')
-                fname, full_path = self._get_path(bin_value, checksum)
-                key = self._get_s3_key(bin_value, checksum)
-
+            write_behind = self._s3_write_mode() == 'behind'
+            metadata = None
+            try:
+                s3_key = s3_bucket.Object(key)
                 try:
-                    s3_key = self._s3_bucket.Object(key)
-                    metadata = {
-                        'name': self.name or '',
-                        'res_id': str(self.res_id) or '',
-                        'res_model': self.res_model or '',
-                        'description': self.description or '',
-                        'create_date': str(self.create_date or '')
-                    }
-                    s3_key.put(Body=bin_value, Metadata=metadata)
-                    # Storing this info because can be usefull for later having public urls for assets
-                    if not attachment.s3_key:
+                    # the write-behind mode does not wait for a HEAD either
+                    exists = self._s3_key_exists(connection, key, fname, remote=not write_behind)
+                except Exception as ex:
+                    _logger.warning('S3: _file_write was not able to look for key:%s, uploading it: %s', key, ex)
+                    exists = False
+                if exists:
+                    # content addressed key: the very same bytes are already stored
+                    connection.stats.incr('dedup_hits')
+                    connection.stats.incr('dedup_bytes_saved', len(bin_value))
+                    metrics.incr('s3_writes_total', outcome='dedup')
+                    _logger.debug('S3: _file_write key:%s already in the bucket, upload skipped', key)
+                else:
+                    attachment = self[:1]
+                    body, metadata = self._s3_encode(bin_value, attachment.mimetype, {
+                        'name': attachment.name or '',
+                        'res_id': str(attachment.res_id) or '',
+                        'res_model': attachment.res_model or '',
+                        'description': attachment.description or '',
+                        'create_date': str(attachment.create_date or '')
+                    })
+                    if write_behind:
+                        self._s3_staging().put(fname, body, metadata)
+                        connection.stats.incr('staged')
+                        metrics.incr('s3_writes_total', outcome='staged')
+                        _logger.debug('S3: _file_write key:%s staged for upload', key)
+                    else:
+                        self._s3_upload(s3_key, body, metadata)
+                        connection.stored(key)
+                        connection.stats.incr('uploads')
+                        connection.stats.incr('bytes_uploaded', len(body))
+                        metrics.incr('s3_writes_total', outcome='upload')
+                        _logger.debug('S3: _file_write  key:%s was successfully uploaded', key)
+                    self._s3_clear_corrupt(fname)
+                # Storing this info because can be usefull for later having public urls for assets
+                for attachment in self:
+                    if not attachment.s3_key or (attachment.s3_tier or None) != tier:
                         attachment.s3_url = '%s/%s/%s' % (s3_key.meta.client.meta.endpoint_url , s3_key.bucket_name, s3_key.key)
                         attachment.s3_key = s3_key.key
-                    _logger.debug('S3: _file_write  key:%s was successfully uploaded', key)
-                except Exception:
-                    _logger.error('S3: _file_write was not able to write, gonna try other filestore key:%s', key)
-                    # Only try filesystem if the not copied to S3
-                    if not self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to', False):
-                        return super(S3Attachment, self)._file_write(value, checksum)
+                        attachment.s3_tier = tier
+            except Exception:
+                _logger.error('S3: _file_write was not able to write key:%s', key, exc_info=True)
+                copied_to = self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to',
+                                                                             False)
+                # without a filestore to fall back to, the staging is tried again
+                if not write_behind or copied_to:
+                    if metadata is None:
+                        # failed before the encoding, the raw bytes are staged
+                        body, metadata = bin_value, {}
+                    # the staging cron will upload it
+                    try:
+                        self._s3_staging().put(fname, body, metadata)
+                        connection.stats.incr('staged')
+                        metrics.incr('s3_writes_total', outcome='staged')
+                        self._s3_clear_corrupt(fname)
+                        for attachment in self:
+                            attachment.s3_url = '%s/%s/%s' % (s3_key.meta.client.meta.endpoint_url, s3_key.bucket_name, s3_key.key)
+                            attachment.s3_key = s3_key.key
+                            attachment.s3_tier = tier
+                        return fname
+                    except Exception:
+                        _logger.error('S3: _file_write was not able to stage key:%s either', key, exc_info=True)
+                if copied_to:
+                    # never hand out a file name whose content is nowhere
+                    raise Exception('The file %s could not be written to S3 nor staged.' % fname)
+                _logger.error('S3: _file_write gonna try other filestore key:%s', key)
+                metrics.incr('s3_writes_total', outcome='fallback')
+                return super(S3Attachment, self)._file_write(value, checksum)
         else:
             _logger.debug('S3: _file_write bypass to filesystem storage: %s', storage)
             return super(S3Attachment, self)._file_write(value, checksum)
@@ -175,20 +805,323 @@ class S3Attachment(models.Model):
         # Returning the file name
         return fname
 
+    @api.model
+    def _s3_write_mode(self):
+        """How _file_write stores new files (ir_attachment.s3_write_mode): 'sync'
+        uploads them in the request, 'behind' stages them on the local disk and
+        lets the cron upload them."""
+        return self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_write_mode', 'sync')
+
+    @api.model
+    def _s3_staging(self):
+        """Return the local staging area of this database, in
+        ir_attachment.s3_staging_dir (<data_dir>/s3_staging by default)."""
+        directory = self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_staging_dir') \
+            or os.path.join(config['data_dir'], 's3_staging')
+        return Staging(os.path.join(directory, self.env.registry.db_name))
+
+    @api.model
+    def _s3_read_staged(self, fname, bin_size=False):
+        """Read ``fname`` from the staging area if it still waits for its upload,
+        else return None."""
+        staging = self._s3_staging()
+        if bin_size:
+            path = staging.get_path(fname)
+            if not path:
+                return None
+            raw_size = staging.metadata(fname).get('raw-size')
+            try:
+                return human_size(int(raw_size) if raw_size else os.path.getsize(path))
+            except OSError:
+                return None
+        data = staging.get(fname)
+        if data is None:
+            return None
+        _logger.debug('S3: _file_read read %s from the staging area', fname)
+        return base64.b64encode(compression.decode(data, staging.metadata(fname)))
+
+    @api.model
+    def _s3_drain_staging(self):
+        """Upload the staged files to S3, run by a cron.
+
+        ir_attachment.s3_staging_workers threads (4) upload for at most
+        ir_attachment.s3_staging_time_budget seconds (50). A failed upload is
+        retried later with an exponential backoff. Staged files that no
+        attachment references ir_attachment.s3_staging_grace seconds (a day)
+        after being written belong to a rolled back transaction or were garbage
+        collected, they are dropped, unless a transaction started before their
+        writing is still open (it may commit their attachment).
+        """
+        storage = self._storage()
+        staging = self._s3_staging()
+        if storage[:5] != 's3://' or not os.path.isdir(staging.directory):
+            return 0
+        transfer_config = self._s3_transfer_config()
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        workers = max(1, min(int(get_param('ir_attachment.s3_staging_workers', 4)),
+                             _registry_options()['max_pool_connections']))
+        deadline = time.time() + float(get_param('ir_attachment.s3_staging_time_budget', 50))
+        grace = float(get_param('ir_attachment.s3_staging_grace', STAGING_GRACE))
+
+        uploaded = dropped = failed = 0
+        pending = staging.pending()
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            while time.time() < deadline:
+                batch = list(itertools.islice(pending, STAGING_BATCH_SIZE))
+                if not batch:
+                    break
+                self._cr.execute("""SELECT store_fname, max(s3_tier) FROM ir_attachment
+                                    WHERE store_fname IN %s GROUP BY store_fname""",
+                                 [tuple(fname for fname, mtime in batch)])
+                referenced = dict(self._cr.fetchall())
+                self._cr.execute("""SELECT EXTRACT(epoch FROM min(xact_start))::float FROM pg_stat_activity
+                                    WHERE datname = current_database() AND pid <> pg_backend_pid()""")
+                oldest_transaction = self._cr.fetchone()[0]
+                jobs = {}
+                for fname, mtime in batch:
+                    if fname in referenced:
+                        try:
+                            connection = self._s3_connection_for(fname, referenced[fname])
+                        except CircuitOpen:
+                            # its bucket is failing, left for a next run
+                            continue
+                        except Exception as ex:
+                            failed += 1
+                            attempts = staging.failed(fname)
+                            _logger.warning('S3: upload of staged %s failed to connect (attempt %d): %s',
+                                            fname, attempts, ex)
+                            continue
+                        jobs[executor.submit(self._s3_upload_staged, connection, staging, fname,
+                                             transfer_config)] = fname
+                    elif mtime < time.time() - grace and (oldest_transaction is None
+                                                          or mtime < oldest_transaction):
+                        staging.remove(fname)
+                        dropped += 1
+                for job in futures.as_completed(jobs):
+                    fname = jobs[job]
+                    if job.exception() is None:
+                        uploaded += 1
+                        continue
+                    failed += 1
+                    attempts = staging.failed(fname)
+                    _logger.warning('S3: upload of staged %s failed (attempt %d): %s',
+                                    fname, attempts, job.exception())
+        finally:
+            executor.shutdown(wait=True)
+        metrics.flush(metrics_directory())
+        if uploaded or dropped or failed:
+            _logger.info('S3: staging %d uploaded, %d dropped, %d failed', uploaded, dropped, failed)
+        return uploaded
+
+    def _s3_upload_staged(self, connection, staging, fname, transfer_config):
+        # runs in a thread: no cursor here
+        data = staging.get(fname)
+        if data is None:
+            return
+        key = self._s3_key_from_fname(fname)
+        self._s3_upload(connection.bucket.Object(key), data, staging.metadata(fname), transfer_config)
+        connection.stored(key)
+        connection.stats.incr('uploads')
+        connection.stats.incr('bytes_uploaded', len(data))
+        staging.remove(fname)
+
+    def _s3_trash_key(self, fname):
+        return self._s3_key_from_fname('trash/%s' % fname)
+
     @api.model
     def _file_gc_s3(self):
+        """Move to the trash the objects of the checklist that are not
+        referenced anymore.
+
+        The checklist is processed by batches of 1000 keys: ir_attachment is
+        only locked while looking for the references of a batch, the objects are
+        copied to the trash by a pool of ir_attachment.s3_gc_workers threads and
+        deleted with DeleteObjects requests. A run stops after
+        ir_attachment.s3_gc_max_keys checklist keys or
+        ir_attachment.s3_gc_time_budget seconds, the next one continues.
+
+        The checklist table is split in ir_attachment.s3_gc_shards shards by
+        file name, each one collected by a single run at a time, so that
+        several runs (e.g. copies of the garbage collection cron) share the
+        work without ever handling the same file. The number of shards must
+        not change while runs are in flight, the shards of two runs using
+        different numbers would overlap.
+        """
         storage = self._storage()
         if storage[:5] != 's3://':
             return
 
         try:
-            if not self._s3_bucket:
-                self._s3_bucket = self._connect_to_S3_bucket(storage)
+            for url in self._s3_layout().urls():
+                self._s3_connection(url)
             _logger.debug('S3: _file_gc_s3 connected Sucessfuly (%s)', storage)
         except Exception:
             _logger.error('S3: _file_gc_s3 was not able to connect (%s)', storage)
             return False
 
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_keys = int(get_param('ir_attachment.s3_gc_max_keys', 100000))
+        deadline = time.time() + float(get_param('ir_attachment.s3_gc_time_budget', 300))
+        workers = int(get_param('ir_attachment.s3_gc_workers', 8))
+
+        run = {'checked': 0, 'removed': 0, 'max_keys': max_keys, 'deadline': deadline}
+        backends = Backends(workers)
+        try:
+            shards = list(range(max(1, int(get_param('ir_attachment.s3_gc_shards', 1)))))
+            # concurrent runs start on different shards
+            random.shuffle(shards)
+            for shard in shards:
+                if self._s3_gc_over_limits(run):
+                    break
+                if self._s3_gc_try_lock(shard):
+                    try:
+                        self._s3_gc_db_checklist(backends, run, shard, len(shards))
+                    except Exception:
+                        # an aborted transaction would refuse the unlock, leaving the shard locked
+                        self._cr.rollback()
+                        raise
+                    finally:
+                        self._s3_gc_unlock(shard)
+            if not self._s3_gc_over_limits(run) and self._s3_gc_bucket_checklist_pending() \
+                    and self._s3_gc_try_lock(-1):
+                try:
+                    self._s3_gc_bucket_checklist(backends, run)
+                except Exception:
+                    self._cr.rollback()
+                    raise
+                finally:
+                    self._s3_gc_unlock(-1)
+        except ClientError as ex:
+            _logger.error('S3: _file_gc_s3 %s:%s', ex.response['Error']['Code'], ex.response['Error']['Message'])
+        except Exception:
+            _logger.error('S3: _file_gc_s3 was not able to gc', exc_info=True)
+        finally:
+            backends.close()
+        if self._s3_gc_over_limits(run):
+            _logger.info("S3: filestore gc stopped by its limits, will continue on next run")
+        metrics.incr('s3_gc_keys_total', run['checked'], result='checked')
+        metrics.incr('s3_gc_keys_total', run['removed'], result='removed')
+        metrics.flush(metrics_directory())
+        _logger.info("S3: filestore gc %d checked, %d removed", run['checked'], run['removed'])
+        return {'checked': run['checked'], 'removed': run['removed']}
+
+    @api.model
+    def _s3_gc_grace(self):
+        """Seconds a mark waits before its file is collected
+        (ir_attachment.s3_gc_grace, a day by default).
+
+        Until then another worker may still dedup against the file, from the
+        keys it knows (s3_known_keys_ttl) or in a transaction that has not
+        committed yet, so it is never shorter than the known keys TTL.
+        """
+        grace = int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_gc_grace', GC_GRACE))
+        return max(grace, 2 * _registry_options()['known_keys_ttl'])
+
+    def _s3_gc_over_limits(self, run):
+        return run['checked'] >= run['max_keys'] or time.time() > run['deadline']
+
+    def _s3_gc_try_lock(self, shard):
+        # session level: held across the commits of the run
+        self._cr.execute("SELECT pg_try_advisory_lock(%s, %s)", [GC_LOCK, shard])
+        return self._cr.fetchone()[0]
+
+    def _s3_gc_unlock(self, shard):
+        self._cr.execute("SELECT pg_advisory_unlock(%s, %s)", [GC_LOCK, shard])
+
+    @api.model
+    def _s3_gc_db_checklist(self, backends, run, shard=0, shards=1):
+        """Collect the files of a shard of the ir_attachment_s3_checklist table.
+
+        Only the files marked before the grace period (_s3_gc_grace), and not
+        again since, are collected. Processed rows are deleted, along with the
+        other marks of the same files; the rows of files that could not be
+        collected are only retried after GC_RETRY_DELAY.
+        """
+        cr = self._cr
+        last_id = 0
+        grace = self._s3_gc_grace()
+        while not self._s3_gc_over_limits(run):
+            cr.execute("""SELECT id, store_fname FROM ir_attachment_s3_checklist mark
+                          WHERE id > %s AND mod(hashtext(store_fname) & 2147483647, %s) = %s
+                            AND (retry_after IS NULL OR retry_after < now() at time zone 'UTC')
+                            AND (create_date IS NULL
+                                 OR create_date < now() at time zone 'UTC' - %s * interval '1 second')
+                            AND NOT EXISTS (SELECT 1 FROM ir_attachment_s3_checklist recent
+                                            WHERE recent.store_fname = mark.store_fname
+                                              AND recent.create_date >= now() at time zone 'UTC'
+                                                                        - %s * interval '1 second')
+                          ORDER BY id LIMIT %s""", [last_id, shards, shard, grace, grace, DELETE_BATCH_SIZE])
+            rows = cr.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            fnames = set(fname for row_id, fname in rows)
+            removed, retry = self._s3_gc_batch(backends, fnames)
+            done = tuple(fnames - retry)
+            if done:
+                cr.execute("DELETE FROM ir_attachment_s3_checklist WHERE store_fname IN %s AND id <= %s",
+                           [done, last_id])
+            if retry:
+                cr.execute("""UPDATE ir_attachment_s3_checklist
+                              SET retry_after = now() at time zone 'UTC' + interval %s
+                              WHERE store_fname IN %s AND id <= %s""", [GC_RETRY_DELAY, tuple(retry), last_id])
+            self._s3_commit()
+            run['checked'] += len(rows)
+            run['removed'] += removed
+
+    @api.model
+    def _s3_gc_bucket_checklist_pending(self):
+        """Tell whether the checklist/ prefix of the bucket may hold marks: it is
+        not listed anymore once found empty, unless marks are written there."""
+        return not self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_gc_bucket_checklist_done')
+
+    @api.model
+    def _s3_gc_bucket_checklist(self, backends, run):
+        """Collect the files marked under the checklist/ prefix of the buckets
+        before the grace period (_s3_gc_grace)."""
+        checklist_prefix = self._s3_key_from_fname('checklist') + '/'
+        before = datetime.datetime.now(tzutc()) - datetime.timedelta(seconds=self._s3_gc_grace())
+        found = False
+        for url in self._s3_layout().urls():
+            connection = self._s3_connection(url)
+            if connection.client.list_objects_v2(Bucket=connection.bucket_name, Prefix=checklist_prefix,
+                                                 MaxKeys=1).get('KeyCount'):
+                found = True
+            batch = []
+            listing = iter_objects(connection.client, connection.bucket_name, checklist_prefix,
+                                   modified_before=before)
+            for check_key, size in itertools.chain(listing, [(None, None)]):
+                if check_key is not None:
+                    batch.append((check_key[len(checklist_prefix):], check_key))
+                    if len(batch) < DELETE_BATCH_SIZE:
+                        continue
+                if not batch:
+                    break
+                removed, retry = self._s3_gc_batch(backends, set(fname for fname, key in batch))
+                # the checklist entries of the failed keys stay for the next run
+                backends.get(connection).delete_many([key for fname, key in batch if fname not in retry])
+                run['checked'] += len(batch)
+                run['removed'] += removed
+                batch = []
+                if self._s3_gc_over_limits(run):
+                    return
+        if not found and self.env['ir.config_parameter'].sudo().get_param(
+                'ir_attachment.s3_gc_mark_mode', 'db') == 'db':
+            # nothing left from the marks written in the buckets
+            self.env['ir.config_parameter'].sudo().set_param('ir_attachment.s3_gc_bucket_checklist_done', '1')
+            self._s3_commit()
+
+    @api.model
+    def _s3_gc_batch(self, backends, fnames):
+        """Collect a batch of file names.
+
+        The tier of an unreferenced file is not known anymore: its bucket in
+        every tier is looked at.
+
+        :return: the number of files moved to the trash and the set of file
+                 names to check again later, because they could not be removed
+        """
         # Continue in a new transaction. The LOCK statement below must be the
         # first one in the current transaction, otherwise the database snapshot
         # used by it may not contain the most recent changes made to the table
@@ -197,60 +1130,524 @@ class S3Attachment(models.Model):
         # But this transaction will not see the new attachements if it has done
         # other requests before the LOCK (like the method _storage() above).
         cr = self._cr
-        cr.commit()
+        self._s3_commit()
 
         # prevent all concurrent updates on ir_attachment while collecting!
         cr.execute("LOCK ir_attachment IN SHARE MODE")
+        cr.execute("SELECT store_fname FROM ir_attachment WHERE store_fname IN %s", [tuple(fnames)])
+        whitelist = set(row[0] for row in cr.fetchall())
+        # commit to release the lock, S3 is only called without it
+        self._s3_commit()
+
+        layout = self._s3_layout()
+        by_url = {}
+        for fname in fnames:
+            if fname not in whitelist:
+                for url in layout.urls_for(fname):
+                    by_url.setdefault(url, []).append(fname)
+        retry = set()
+        moved = {}
+        for url, url_fnames in by_url.items():
+            connection = self._s3_connection(url)
+            backend = backends.get(connection)
+            key_fnames = dict((self._s3_key_from_fname(fname), fname) for fname in url_fnames)
+            garbage = [(key, self._s3_trash_key(fname)) for key, fname in key_fnames.items()]
+            copied, missing, failed = backend.copy_many(garbage)
+            not_deleted = backend.delete_many([key for key, trash_key in copied])
+            for key, trash_key in copied:
+                connection.known_keys.discard(key)
+                connection.missing_keys.discard(trash_key)
+                _logger.debug('S3: _file_gc_s3 deleted key:%s successfully (moved to %s)', key, trash_key)
+                if key not in not_deleted:
+                    moved.setdefault(key_fnames[key], []).append(connection)
+            retry.update(key_fnames[key] for key, trash_key in failed)
+            retry.update(key_fnames[key] for key in not_deleted)
+
+        # a file referenced again since the lock was released gets restored
+        if moved:
+            cr.execute("SELECT store_fname FROM ir_attachment WHERE store_fname IN %s", [tuple(moved)])
+            revived = set(row[0] for row in cr.fetchall())
+            if revived:
+                _logger.info('S3: _file_gc_s3 restoring %d keys referenced again', len(revived))
+                restore = {}
+                for fname in revived:
+                    for connection in moved.pop(fname):
+                        restore.setdefault(connection, []).append(
+                            (self._s3_trash_key(fname), self._s3_key_from_fname(fname)))
+                for connection, pairs in restore.items():
+                    for trash_key, key in backends.get(connection).copy_many(pairs)[0]:
+                        connection.stored(key)
+        return len(moved), retry
+
+    @api.model
+    def _s3_expire_trash(self):
+        """Delete the objects trashed more than ir_attachment.s3_trash_retention_days
+        days ago (30, 0 keeps them forever) with DeleteObjects requests, for at most
+        ir_attachment.s3_gc_time_budget seconds.
+
+        Nothing is done when ir_attachment.s3_trash_expiry is 'lifecycle': a
+        rule of the bucket expires the trash then, see _s3_apply_trash_lifecycle.
+
+        :return: the number of deleted objects and of bytes reclaimed
+        """
+        storage = self._storage()
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        days = int(get_param('ir_attachment.s3_trash_retention_days', 30))
+        if storage[:5] != 's3://' or days <= 0 or get_param('ir_attachment.s3_trash_expiry', 'delete') != 'delete':
+            return 0, 0
+        deadline = time.time() + float(get_param('ir_attachment.s3_gc_time_budget', 300))
+        before = datetime.datetime.now(tzutc()) - datetime.timedelta(days=days)
+
+        expired = reclaimed = 0
+        prefix = self._s3_key_from_fname('trash') + '/'
+        for url in self._s3_layout().urls():
+            connection = self._s3_connection(url)
+            batch = []
+            listing = iter_objects(connection.client, connection.bucket_name, prefix, modified_before=before)
+            for key, size in itertools.chain(listing, [(None, 0)]):
+                if key is not None:
+                    batch.append((key, size))
+                    if len(batch) < DELETE_BATCH_SIZE:
+                        continue
+                if not batch:
+                    break
+                failed = delete_keys(connection.client, connection.bucket_name, [key for key, size in batch])
+                for key, size in batch:
+                    if key not in failed:
+                        connection.missing_keys.add(key)
+                        expired += 1
+                        reclaimed += size
+                batch = []
+                if time.time() > deadline:
+                    break
+            if time.time() > deadline:
+                _logger.info('S3: trash expiry stopped by its time budget, will continue on next run')
+                break
+        metrics.incr('s3_trash_keys_total', expired, action='expired')
+        metrics.incr('s3_trash_bytes_total', reclaimed, action='expired')
+        _logger.info('S3: trash expiry deleted %d objects, %s reclaimed', expired, human_size(reclaimed))
+        return expired, reclaimed
+
+    @api.model
+    def _s3_apply_trash_lifecycle(self):
+        """Let S3 expire the trash of this database: add (or update) a lifecycle
+        rule of each bucket expiring it after the retention, keeping the other
+        rules, and stop the expiry by _s3_expire_trash.
+
+        :return: the lifecycle rules by bucket name
+        """
+        storage = self._storage()
+        if storage[:5] != 's3://':
+            return {}
+        params = self.env['ir.config_parameter'].sudo()
+        days = int(params.get_param('ir_attachment.s3_trash_retention_days', 30))
+        if days <= 0:
+            raise Exception('A lifecycle rule needs a positive ir_attachment.s3_trash_retention_days.')
+        rule_id = 'odoo-s3-trash-%s' % self.env.registry.db_name
+        result = {}
+        for url in self._s3_layout().urls():
+            connection = self._s3_connection(url)
+            try:
+                rules = connection.client.get_bucket_lifecycle_configuration(Bucket=connection.bucket_name)['Rules']
+            except ClientError as ex:
+                if ex.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+                    raise
+                rules = []
+            rules = [rule for rule in rules if rule.get('ID') != rule_id]
+            rules.append({
+                'ID': rule_id,
+                'Filter': {'Prefix': self._s3_key_from_fname('trash') + '/'},
+                'Status': 'Enabled',
+                'Expiration': {'Days': days},
+            })
+            connection.client.put_bucket_lifecycle_configuration(
+                Bucket=connection.bucket_name, LifecycleConfiguration={'Rules': rules})
+            result[connection.bucket_name] = rules
+            _logger.info('S3: trash of %s now expired by the lifecycle rule %s after %d days',
+                         connection.bucket_name, rule_id, days)
+        params.set_param('ir_attachment.s3_trash_expiry', 'lifecycle')
+        return result
+
+    @api.multi
+    def _s3_restore_from_trash(self):
+        """Restore the trashed objects of the attachments, typically the ones
+        flagged s3_lost, with the batch backend (ir_attachment.s3_gc_workers
+        threads by default). Restored attachments are not flagged s3_lost
+        anymore.
+
+        :return: a dict with the number of files ``restored``, ``missing`` from
+                 the trash and ``failed``, and the ``bytes`` restored
+        """
+        storage = self._storage()
+        sizes = dict((attach.store_fname, attach.file_size or 0) for attach in self if attach.store_fname)
+        result = {'restored': 0, 'missing': 0, 'failed': 0, 'bytes': 0}
+        if storage[:5] != 's3://' or not sizes:
+            return result
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_gc_workers', 8))
+        # the trash of a file is in the bucket of its tier
+        layout = self._s3_layout()
+        by_url = {}
+        for attach in self:
+            if attach.store_fname:
+                by_url.setdefault(layout.url_for(attach.store_fname, attach.s3_tier), set()).add(attach.store_fname)
+        restored = set()
+        missing = failed = 0
+        for url, url_fnames in by_url.items():
+            connection = self._s3_connection(url)
+            fnames = dict((self._s3_trash_key(fname), fname) for fname in url_fnames)
+            pairs = [(trash_key, self._s3_key_from_fname(fname)) for trash_key, fname in fnames.items()]
+            with ThreadedBackend(connection, min(workers, len(pairs))) as backend:
+                copied, url_missing, url_failed = backend.copy_many(pairs)
+                backend.delete_many([trash_key for trash_key, key in copied])
+            for trash_key, key in copied:
+                connection.stored(key)
+                connection.missing_keys.add(trash_key)
+                restored.add(fnames[trash_key])
+            missing += len(url_missing)
+            failed += len(url_failed)
+        self.filtered(lambda a: a.s3_lost and a.store_fname in restored).write({'s3_lost': False})
+
+        result.update(restored=len(restored), missing=missing, failed=failed,
+                      bytes=sum(sizes[fname] for fname in restored))
+        metrics.incr('s3_trash_keys_total', result['restored'], action='restored')
+        metrics.incr('s3_trash_bytes_total', result['bytes'], action='restored')
+        _logger.info('S3: restored %d files (%s) from the trash, %d missing, %d failed',
+                     result['restored'], human_size(result['bytes']), result['missing'], result['failed'])
+        return result
+
+    def _s3_commit(self):
+        """Commit the work done so far by a batch job, except in the tests,
+        whose transaction is rolled back."""
+        if not getattr(threading.currentThread(), 'testing', False):
+            self._cr.commit()
+
+    @api.model
+    def _s3_apply_tiering(self):
+        """Move the files whose tier changed according to the rules of
+        ir_attachment.s3_tiers, e.g. with their age, run daily by a cron.
+
+        The tier of a file follows its most recently created attachment. The
+        file is copied to its bucket in the new tier, its attachments are
+        updated and committed, then the old object is moved to the trash of
+        its bucket, from where a late read still restores it. The run stops
+        after ir_attachment.s3_gc_time_budget seconds (300) and the next one
+        continues from the file name where it stopped
+        (ir_attachment.s3_tiering_position), starting over once all the files
+        were seen.
+
+        :return: the number of files moved
+        """
+        layout = self._s3_layout()
+        if self._storage()[:5] != 's3://' or not layout.tiered:
+            return 0
+        params = self.env['ir.config_parameter'].sudo()
+        deadline = time.time() + float(params.get_param('ir_attachment.s3_gc_time_budget', 300))
+        workers = int(params.get_param('ir_attachment.s3_gc_workers', 8))
+        cr = self._cr
+        moved = 0
+        last_fname = params.get_param('ir_attachment.s3_tiering_position') or ''
+        with Backends(workers) as backends:
+            while time.time() < deadline:
+                cr.execute("""SELECT DISTINCT ON (store_fname) store_fname, s3_tier, res_model, mimetype,
+                                     file_size,
+                                     COALESCE(EXTRACT(day FROM now() at time zone 'UTC' - create_date), 0)
+                              FROM ir_attachment WHERE store_fname > %s
+                              ORDER BY store_fname, create_date DESC LIMIT %s""", [last_fname, TIERING_BATCH_SIZE])
+                rows = cr.fetchall()
+                if not rows:
+                    # every file was seen, the next run starts over
+                    last_fname = ''
+                    break
+                last_fname = rows[-1][0]
+                moves = {}
+                for fname, tier, res_model, mimetype, size, age_days in rows:
+                    target = layout.tier_for(res_model, mimetype, size, age_days)
+                    if target != (tier or DEFAULT_TIER):
+                        urls = (layout.url_for(fname, tier), layout.url_for(fname, target))
+                        moves.setdefault(urls + (target,), []).append(fname)
+                for (source_url, target_url, target), fnames in moves.items():
+                    moved += self._s3_move_files(backends, source_url, target_url, target, fnames)
+                params.set_param('ir_attachment.s3_tiering_position', last_fname)
+                self._s3_commit()
+        params.set_param('ir_attachment.s3_tiering_position', last_fname)
+        if moved:
+            _logger.info('S3: tiering moved %d files', moved)
+        return moved
 
+    @api.model
+    def _s3_move_files(self, backends, source_url, target_url, tier, fnames):
+        """Move ``fnames`` to ``tier``, from the bucket of ``source_url`` to
+        the one of ``target_url``.
+
+        :return: the number of files moved
+        """
+        source = self._s3_connection(source_url)
+        target = self._s3_connection(target_url)
+        key_fnames = dict((self._s3_key_from_fname(fname), fname) for fname in fnames)
+        if source is target:
+            copied = list(key_fnames)
+        else:
+            server_side = self._s3_same_account(source, target)
+            executor = futures.ThreadPoolExecutor(max_workers=max(1, min(backends.concurrency, len(key_fnames))))
+            try:
+                copied, missing, failed = transfer_keys(executor, source.client, source.bucket_name, target.client,
+                                                        target.bucket_name, list(key_fnames), server_side)
+            finally:
+                executor.shutdown(wait=True)
+            for key in copied:
+                target.stored(key)
+        if not copied:
+            return 0
+        url_prefix = '%s/%s/%s' % (target.client.meta.endpoint_url, target.bucket_name, self._s3_key_from_fname(''))
+        cr = self._cr
+        cr.execute("""UPDATE ir_attachment SET s3_tier = %s, s3_url = %s || store_fname
+                      WHERE store_fname IN %s""", [tier, url_prefix, tuple(key_fnames[key] for key in copied)])
+        self._s3_commit()
+        if source is not target:
+            trashed, missing, failed = backends.get(source).copy_many(
+                [(key, self._s3_trash_key(key_fnames[key])) for key in copied])
+            backends.get(source).delete_many([key for key, trash_key in trashed])
+            for key, trash_key in trashed:
+                source.known_keys.discard(key)
+                source.missing_keys.discard(trash_key)
+        _logger.debug('S3: tiering moved %d files from %s to %s (%s)', len(copied), source_url, target_url, tier)
+        return len(copied)
+
+    @api.model
+    def _s3_scrub(self):
+        """Check the objects of the database against the SHA1 of their key,
+        run by a cron.
+
+        The buckets are walked in key order from where the previous run
+        stopped (ir_attachment.s3_scrub_position) and start over once done.
+        ir_attachment.s3_scrub_workers threads (4) download the objects and
+        hash them as they come, at most ir_attachment.s3_scrub_bytes_per_second
+        bytes per second in all (5MB, 0 for no limit), for
+        ir_attachment.s3_scrub_time_budget seconds (300). The attachments of a
+        corrupt object are flagged s3_corrupt.
+
+        :return: a dict with the number of objects checked, corrupt and failed
+                 and the bytes read
+        """
+        result = {'checked': 0, 'corrupt': 0, 'failed': 0, 'bytes': 0}
+        if self._storage()[:5] != 's3://':
+            return result
+        params = self.env['ir.config_parameter'].sudo()
+        deadline = time.time() + float(params.get_param('ir_attachment.s3_scrub_time_budget', 300))
+        rate = int(params.get_param('ir_attachment.s3_scrub_bytes_per_second', 5 * 1024 * 1024))
+        limiter = RateLimiter(rate) if rate > 0 else None
+        workers = int(params.get_param('ir_attachment.s3_scrub_workers', 4))
+        position = json.loads(params.get_param('ir_attachment.s3_scrub_position') or '{}')
+        urls = self._s3_layout().urls()
+        start = urls.index(position['url']) if position.get('url') in urls else 0
+        prefix = self._s3_key_from_fname('')
+        cr = self._cr
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
         try:
-            # retrieve the file names from the checklist
-            checklist = {}
-            for s3_key_gc in self._s3_bucket.objects.filter(Prefix=self._s3_key_from_fname('checklist')):
-                real_key_name = self._s3_key_from_fname(s3_key_gc.key[1 + len(self._s3_key_from_fname('checklist/')):])
-                checklist[real_key_name] = s3_key_gc.key
-
-            # determine which files to keep among the checklist
-            whitelist = set()
-            for names in cr.split_for_in_conditions(checklist):
-                cr.execute("SELECT store_fname FROM ir_attachment WHERE store_fname IN %s", [names])
-                whitelist.update(row[0] for row in cr.fetchall())
-
-            # remove garbage files, and clean up checklist
-            removed = 0
-            for real_key_name, check_key_name in checklist.iteritems():
-                if real_key_name not in whitelist:
-                    # Get the real key from the bucket
-                    s3_key = self._s3_bucket.Object(real_key_name)
-
-                    # new_key = self._s3_key_from_fname('trash/%s' % real_key_name)
-                    new_key = self._s3_key_from_fname('trash/%s' % '/'.join(real_key_name.split('/')[1:]))
-                    trashed_key = self._s3_bucket.Object(new_key).copy_from(
-                        CopySource={'Bucket': self._s3_bucket.name, 'Key': real_key_name})
-                    s3_key.delete()
-                    s3_key_gc = self._s3_bucket.Object(check_key_name)
-                    s3_key_gc.delete()
-                    removed += 1
-                    _logger.debug('S3: _file_gc_s3 deleted key:%s successfully (moved to %s)', real_key_name, trashed_key.key)
+            for url in urls[start:]:
+                connection = self._s3_connection(url)
+                start_after = position.get('key') if position.get('url') == url else None
+                objects = iter_files(connection.client, connection.bucket_name, prefix, start_after=start_after)
+                while time.time() < deadline:
+                    batch = list(itertools.islice(objects, SCRUB_BATCH_SIZE))
+                    if not batch:
+                        break
+                    jobs = dict((executor.submit(self._s3_scrub_object, connection, key, limiter), key)
+                                for key, size in batch if expected_sha1(key[len(prefix):]))
+                    corrupt = []
+                    for job in futures.as_completed(jobs):
+                        key = jobs[job]
+                        error = job.exception()
+                        if error is not None:
+                            if not self._s3_is_missing(error):
+                                # left for the next round
+                                _logger.error('S3: scrub was not able to check key:%s: %s', key, error)
+                                result['failed'] += 1
+                                metrics.incr('s3_scrub_objects_total', result='failed')
+                            continue
+                        valid, size = job.result()
+                        result['checked'] += 1
+                        result['bytes'] += size
+                        metrics.incr('s3_scrub_bytes_total', size)
+                        metrics.incr('s3_scrub_objects_total', result='valid' if valid else 'corrupt')
+                        if not valid:
+                            _logger.error('S3: scrub found the corrupt key:%s', key)
+                            connection.known_keys.discard(key)
+                            corrupt.append(key[len(prefix):])
+                    if corrupt:
+                        result['corrupt'] += len(corrupt)
+                        cr.execute("UPDATE ir_attachment SET s3_corrupt = true WHERE store_fname IN %s",
+                                   [tuple(corrupt)])
+                    position = {'url': url, 'key': batch[-1][0]}
+                    params.set_param('ir_attachment.s3_scrub_position', json.dumps(position))
+                    cr.commit()
+                else:
+                    # out of time
+                    break
+        finally:
+            executor.shutdown(wait=True)
+        if time.time() < deadline:
+            # every bucket was checked, the next run starts over
+            params.set_param('ir_attachment.s3_scrub_position', '')
+        self.invalidate_cache(['s3_corrupt'])
+        metrics.flush(metrics_directory())
+        _logger.info('S3: scrub checked %d objects (%s), %d corrupt, %d failed', result['checked'],
+                     human_size(result['bytes']), result['corrupt'], result['failed'])
+        return result
 
-        except ClientError as ex:
-            _logger.error('S3: _file_gc_s3 (key:%s) (checklist_key:%s) %s:%s', real_key_name, check_key_name,
-                          ex.response['Error']['Code'], ex.response['Error']['Message'])
+    def _s3_scrub_object(self, connection, key, limiter=None):
+        """Download the object of ``key`` and hash its content, in a thread
+        of the scrubber.
+
+        :return: whether the content matches the SHA1 of the key and the size
+                 of the object
+        """
+        response = connection.client.get_object(Bucket=connection.bucket_name, Key=key)
+        chunks = iter_body(response['Body'])
+        if limiter:
+            chunks = limiter.throttle(chunks)
+        codec = response.get('Metadata', {}).get('codec')
+        if codec:
+            chunks = compression.iter_decompress(chunks, codec)
+        sha, size = sha1_of(chunks)
+        return sha == expected_sha1(key.split('/', 1)[-1]), response['ContentLength']
+
+    def _s3_same_account(self, source, target):
+        """Whether objects can be copied server side between the buckets of
+        two connections."""
+        return source.profile_name == target.profile_name \
+            and source.options.get('endpoint_url') == target.options.get('endpoint_url')
 
-        except Exception as ex:
-            _logger.error('S3: _file_gc_s3 was not able to gc (key:%s) (checklist_key:%s)', real_key_name, check_key_name)
+    @api.model
+    def _s3_file_index(self):
+        """The files of the attachments packed by tier (``{tier: KeyIndex}``),
+        read through a server side cursor."""
+        cr = self._cr
+        cr.execute("SELECT DISTINCT COALESCE(s3_tier, %s) FROM ir_attachment WHERE store_fname IS NOT NULL",
+                   [DEFAULT_TIER])
+        indexes = {}
+        for tier, in cr.fetchall():
+            cr.execute("""DECLARE s3_files NO SCROLL CURSOR FOR
+                          SELECT DISTINCT store_fname FROM ir_attachment
+                          WHERE store_fname IS NOT NULL AND COALESCE(s3_tier, %s) = %s""", [DEFAULT_TIER, tier])
+            try:
+                indexes[tier] = KeyIndex(self._s3_fetch_cursor('s3_files'), '')
+            finally:
+                cr.execute("CLOSE s3_files")
+        return indexes
+
+    def _s3_fetch_cursor(self, name):
+        while True:
+            self._cr.execute("FETCH %s FROM " + name, [AUDIT_FETCH_SIZE])
+            rows = self._cr.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+
+    @api.model
+    def _s3_download_filestore(self, filestore=None, referenced_only=True):
+        """Download the files of the database missing in the local filestore
+        (``filestore``, the one of the database by default), e.g. to leave S3
+        or to restore a copy of the database elsewhere.
+
+        Every bucket of the storage is listed and only the files of the
+        attachments are downloaded, unless not ``referenced_only``. The
+        download runs on ir_attachment.s3_migration_workers threads and
+        resumes from the checkpoint saved in the data directory.
+
+        :return: the statistics of the transfer, throughput included
+        """
+        if self._storage()[:5] != 's3://':
+            return {}
+        filestore = filestore or self._filestore()
+        db_name = self.env.registry.db_name
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_migration_workers', 16))
+        accept = None
+        if referenced_only:
+            indexes = self._s3_file_index().values()
+            accept = lambda name: any(name in index for index in indexes)
+        stats = {}
+        for url in self._s3_layout().urls():
+            connection = self._s3_connection(url)
+            download = BucketToFilestore(
+                connection.client, connection.bucket_name, db_name, filestore,
+                checkpoint=os.path.join(config['data_dir'], 's3_download_%s_%s.json' % (db_name, connection.bucket_name)),
+                workers=max(1, min(workers, _registry_options()['max_pool_connections'])), accept=accept)
+            _add_stats(stats, download.run())
+        _logger.info('S3: downloaded %d files to %s (%.2f MB/s)', stats['copied'], filestore,
+                     stats['bytes_per_second'] / 1024 / 1024)
+        return stats
+
+    @api.model
+    def _s3_copy_from_database(self, source_db, source_location=None):
+        """Copy the files of the attachments of this database from the
+        ``source_db/`` prefix of ``source_location`` (the current storage by
+        default), e.g. after duplicating or renaming a database, so that they
+        are found under its own prefix.
 
-        # commit to release the lock
-        cr.commit()
-        _logger.info("S3: filestore gc %d checked, %d removed", len(checklist), removed)
+        Each file goes to its bucket of the current storage, server side when
+        both buckets share their credentials and endpoint, and only the files
+        missing there are copied, on ir_attachment.s3_migration_workers
+        threads. The ``s3_key`` and ``s3_url`` still pointing to the source
+        prefix are reset, the next read sets them again.
+
+        :return: the statistics of the transfers, throughput included
+        """
+        if self._storage()[:5] != 's3://':
+            return {}
+        layout = self._s3_layout()
+        db_name = self.env.registry.db_name
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_migration_workers', 16))
+        workers = max(1, min(workers, _registry_options()['max_pool_connections']))
+        source_urls = split_location(source_location) if source_location else layout.urls()
+        indexes = self._s3_file_index()
+
+        def accept_for(url):
+            return lambda name: any(name in index and layout.url_for(name, tier) == url
+                                    for tier, index in indexes.items())
+
+        stats = {}
+        for target_url in layout.urls():
+            target = self._s3_connection(target_url)
+            for source_url in source_urls:
+                source = self._s3_connection(source_url)
+                if source is target and source_db == db_name:
+                    continue
+                checkpoint = 's3_replication_%s_%s_%s_%s.json' % (source_db, source.bucket_name, db_name,
+                                                                  target.bucket_name)
+                replication = BucketToBucket(
+                    source.client, source.bucket_name, source_db, target.client, target.bucket_name, db_name,
+                    server_side=self._s3_same_account(source, target),
+                    checkpoint=os.path.join(config['data_dir'], checkpoint), workers=workers,
+                    accept=accept_for(target_url))
+                _add_stats(stats, replication.run())
+        if source_db != db_name:
+            prefix = source_db + '/'
+            self._cr.execute("""UPDATE ir_attachment SET s3_key = NULL, s3_url = NULL
+                                WHERE left(s3_key, %s) = %s""", [len(prefix), prefix])
+            self.invalidate_cache(['s3_key', 's3_url'])
+        _logger.info('S3: copied %d files from %s (%.2f MB/s)', stats.get('copied', 0), source_db,
+                     stats.get('bytes_per_second', 0) / 1024 / 1024)
+        return stats
 
     def _mark_for_gc(self, fname):
         """ We will mark for garbage collection in both s3 and filesystem
-        Just the garbage collection in s3 will move to trash and not delete"""
+        Just the garbage collection in s3 will move to trash and not delete
+
+        By default the mark is a row of ir_attachment_s3_checklist, written in
+        the current transaction (the file is still referenced if it rolls back)
+        and consumed by _file_gc_s3. Setting ir_attachment.s3_gc_mark_mode to
+        's3' writes an empty object under the checklist/ prefix instead."""
         storage = self._storage()
         if storage[:5] == 's3://':
+            if self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_gc_mark_mode', 'db') == 'db':
+                self._cr.execute("""INSERT INTO ir_attachment_s3_checklist (store_fname, create_date)
+                                    VALUES (%s, now() at time zone 'UTC')""", [fname])
+                _logger.debug('S3: _mark_for_gc fname:%s marked for garbage collection', fname)
+                return
             try:
-                if not self._s3_bucket:
-                    self._s3_bucket = self._connect_to_S3_bucket(storage)
+                s3_bucket = self._s3_connection_for(fname).bucket
                 _logger.debug('S3: File mark as gc. Connected Sucessfuly (%s)', storage)
             except Exception:
                 _logger.error('S3: File mark as gc. Was not able to connect (%s), gonna try other filestore', storage)
@@ -261,9 +1658,13 @@ class S3Attachment(models.Model):
             new_key = self._s3_key_from_fname('checklist/%s' % fname)
 
             try:
-                s3_key = self._s3_bucket.Object(new_key)
+                s3_key = s3_bucket.Object(new_key)
                 # Just create an empty file to
                 s3_key.put(Body='')
+                params = self.env['ir.config_parameter'].sudo()
+                if params.get_param('ir_attachment.s3_gc_bucket_checklist_done'):
+                    # the garbage collection has to list the bucket again
+                    params.set_param('ir_attachment.s3_gc_bucket_checklist_done', False)
                 _logger.debug('S3: _mark_for_gc key:%s marked for garbage collection', new_key)
             except Exception:
                 _logger.error('S3: _mark_for_gc Was not able to save key:%s', new_key)
@@ -280,38 +1681,50 @@ class S3Attachment(models.Model):
                 self._run_copy_filestore_to_s3()
                 _logger.info('S3: filestore copied to S3 successfully')
             except Exception:
-                _logger.info('S3: filestore copy to S3 aborted!')
+                _logger.info('S3: filestore copy to S3 aborted!', exc_info=True)
             return {}
 
     @api.model
     def _run_copy_filestore_to_s3(self):
+        """Upload the files of the local filestore missing in the bucket.
+
+        The copy runs on ir_attachment.s3_migration_workers threads and can be
+        interrupted: the next run resumes from the checkpoint saved in the data
+        directory. The filestore is flagged as copied only once every file made it.
+
+        The files go to the default tier, each bucket of a sharded one getting
+        its own files; the tiering cron moves them to their tier afterwards.
+        """
         storage = self._storage()
-        is_copied = self.env['ir.config_parameter'].sudo().get_param('ir_attachment.location_s3_copied_to', False)
-        scheme, access_type, profile_name, bucket_name = self._parse_storage_url(storage)
-        if scheme == 's3://' and not is_copied:
-            db_name = self.env.registry.db_name
-            s3_url = 's3://%s/%s' % (bucket_name, db_name)
-            full_path = self._full_path('')
-            try:
-                if not self._s3_bucket:
-                    self._s3_bucket = self._connect_to_S3_bucket(storage)
-                _logger.debug('S3: Copy filestore to S3. Connected Sucessfuly (%s)', storage)
-            except Exception:
-                _logger.error('S3: Copy filestore to S3. Was not able to connect (%s), gonna try other filestore',
-                              storage)
-            s3 = boto3.client('s3')
-            db_name = os.path.basename(os.path.dirname(full_path))
-            for root, dirs, files in os.walk(full_path):
-                for file_name in files:
-                    path = os.path.join(root, file_name)
-                    bucket_name = self._s3_bucket.name
-                    s3.upload_file(path, bucket_name,  '%s/%s' % (db_name, path[len(full_path):]))
-                    _logger.debug('S3: Copy filestore to S3. Loading file %s/%s', db_name, path[len(full_path):])
-            self.env['ir.config_parameter'].sudo().set_param('ir_attachment.location_s3_copied_to', '%' % s3_url,
-                                                             groups=['base.group_system'])
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        is_copied = get_param('ir_attachment.location_s3_copied_to', False)
+        if storage[:5] != 's3://' or is_copied:
+            return
+        layout = self._s3_layout()
+        urls = layout.tiers[DEFAULT_TIER]
+        db_name = self.env.registry.db_name
+        workers = int(get_param('ir_attachment.s3_migration_workers', 16))
+        stats = {}
+        s3_urls = []
+        for url in urls:
+            connection = self._s3_connection(url)
+            _logger.debug('S3: Copy filestore to S3. Connected Sucessfuly (%s)', url)
+            s3_urls.append('s3://%s/%s' % (connection.bucket_name, db_name))
+            checkpoint = 's3_migration_%s_%s.json' % (db_name, connection.bucket_name)
+            migration = FilestoreMigration(
+                connection.client, connection.bucket_name, db_name, self._filestore(),
+                checkpoint=os.path.join(config['data_dir'], checkpoint),
+                workers=max(1, min(workers, _registry_options()['max_pool_connections'])),
+                transfer_config=self._s3_transfer_config(),
+                accept=(lambda path, url=url: layout.url_for(path) == url) if len(urls) > 1 else None)
+            _add_stats(stats, migration.run())
+        if stats['failed']:
+            raise Exception('%d files could not be copied to S3' % stats['failed'])
+        self.env['ir.config_parameter'].sudo().set_param('ir_attachment.location_s3_copied_to', ','.join(s3_urls))
+        return stats
 
     @api.multi
-    def check_s3_filestore(self):
+    def check_s3_filestore(self, use_listing=None, report=None):
         """This command is here for being trigger using odoo shell:
 
         e.g.:
@@ -321,59 +1734,158 @@ class S3Attachment(models.Model):
         $> print b # will show totals
         $> env.cr.commit() # need to do this to update the table s3_lost field to know if something is lost
 
+        With ``use_listing`` (the default from LISTING_AUDIT_MIN_RECORDS
+        attachments on) the bucket is listed once instead of sending a HEAD
+        request per attachment. The HEAD requests are sent concurrently by the
+        batch backend otherwise.
+
+        With ``report``, the path of a .jsonl or .csv file, the status of each
+        attachment is written there as soon as it is known and the path is
+        returned instead of the list. See also check_s3_filestore_report.
         """
+        if use_listing is None:
+            use_listing = len(self) >= LISTING_AUDIT_MIN_RECORDS
+        return self._s3_audit('"ir_attachment"', '"ir_attachment".id = ANY(%s)', [list(self.ids)],
+                              use_listing, report)
+
+    @api.model
+    def check_s3_filestore_report(self, report, domain=None, use_listing=True):
+        """check_s3_filestore for all the attachments matching ``domain``, the
+        ones of binary fields included, with a memory use that does not depend
+        on their number: they are read through a server side cursor and their
+        status written in the ``report`` file (.jsonl or .csv).
+
+        $> env['ir.attachment'].check_s3_filestore_report('/tmp/s3_audit.csv')
+
+        :return: the totals
+        """
+        from_clause, where_clause, params = self._where_calc(domain or []).get_sql()
+        result = self._s3_audit(from_clause, where_clause or 'TRUE', params, use_listing, report)
+        return result and result[1]
+
+    @api.model
+    def _s3_audit(self, from_clause, where_clause, params, use_listing, report=None):
         storage = self._storage()
         if storage[:5] != 's3://':
             return
 
         try:
-            if not self._s3_bucket:
-                self._s3_bucket = self._connect_to_S3_bucket(storage)
+            connections = dict((url, self._s3_connection(url)) for url in self._s3_layout().urls())
             _logger.debug('S3: _file_gc_s3 connected Sucessfuly (%s)', storage)
         except Exception:
             _logger.error('S3: _file_gc_s3 was not able to connect (%s)', storage)
             return False
 
-        status_res = []
         totals = {
             'lost_count': 0,
         }
+        statuses = self._s3_iter_audit(connections, use_listing, from_clause, where_clause, params, totals)
+        if report:
+            with ReportWriter(report, AuditStatus.FIELDS) as writer:
+                for status in statuses:
+                    writer.write(status.as_dict())
+            _logger.info('S3: check_s3_filestore wrote the status of %d attachments in %s', writer.count, report)
+            result = report
+        else:
+            result = [status.as_dict() for status in statuses]
+        if totals['lost_count']:
+            _logger.error('S3: check_s3_filestore %d keys not found in the bucket', totals['lost_count'])
+        return result, totals
 
-        for att in self:
-            status = {}
-            status['name'] = att.name
-            status['fname'] = att.store_fname
-            status['s3_lost'] = False
-
-            try:
-                if not att.store_fname:
-                    raise Exception('There is no store_fname')
-                key = self._s3_key_from_fname(att.store_fname)
-                s3_key = self._s3_bucket.Object(key)
-
-                # will return 404 if not exists
-                chk = s3_key.content_type is False
-
-                if not att.s3_key:
-                    att.s3_key = s3_key.key
-                    att.s3_url = '%s/%s/%s' % (
-                        s3_key.meta.client.meta.endpoint_url, s3_key.bucket_name, s3_key.key)
-                    _logger.debug('S3: check_s3_filestore updated s3_url for key:%s', key)
-
-                _logger.debug('S3: check_s3_filestore read key:%s from bucket successfully', key)
-
-            except ClientError as ex:
-                if int(ex.response['Error']['Code']) == 404:
-                    status['s3_lost'] = True
-                    totals['lost_count'] += 1
-
-                _logger.error('S3: check_s3_filestore was not able to read from S3 or other filestore key:%s', key)
-                att.s3_lost = True
-                status['error'] = ex.response['Error']['Message']
+    def _s3_iter_audit(self, connections, use_listing, from_clause, where_clause, params, totals):
+        """Yield the :class:`AuditStatus` of the attachments of the query, read
+        by batches of AUDIT_FETCH_SIZE through a server side cursor; their S3
+        fields are updated in bulk.
 
-            except Exception as e:
-                status['error'] = e.message
-            status_res.append(status)
+        With ``use_listing`` the keys of the database in the buckets
+        (``connections`` by url) are listed first and packed in memory, else
+        the objects of each batch are checked with HEAD requests. A file
+        missing in the listing is checked again with a HEAD, it may have been
+        written since, and a file waiting in the staging area is not lost.
+        """
+        layout = self._s3_layout()
+        prefix = self._s3_key_from_fname('')
+        url_prefixes = dict((url, '%s/%s/%s' % (connection.client.meta.endpoint_url, connection.bucket_name, prefix))
+                            for url, connection in connections.items())
+        indexes = None
+        if use_listing:
+            indexes = {}
+            for url, connection in connections.items():
+                listing = iter_files(connection.client, connection.bucket_name, prefix)
+                indexes[url] = index = KeyIndex((key for key, size in listing), prefix)
+                _logger.info('S3: check_s3_filestore listed %d keys in %s',
+                             len(index), connection.bucket_name)
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('ir_attachment.s3_gc_workers', 8))
 
-        return status_res, totals
+        staging = self._s3_staging()
+        cr = self._cr
+        cr.execute("""DECLARE s3_audit NO SCROLL CURSOR FOR
+                      SELECT "ir_attachment".id, "ir_attachment".name, "ir_attachment".store_fname,
+                             "ir_attachment".s3_key, "ir_attachment".s3_lost, "ir_attachment".s3_tier
+                      FROM %s WHERE %s ORDER BY "ir_attachment".id""" % (from_clause, where_clause), params)
+        backends = Backends(workers)
+        try:
+            while True:
+                cr.execute("FETCH %s FROM s3_audit", [AUDIT_FETCH_SIZE])
+                rows = cr.fetchall()
+                if not rows:
+                    break
+                # without listing every object is checked with a HEAD, else
+                # only the ones missing in the listing, that may be newer
+                by_url = {}
+                for att_id, name, store_fname, s3_key, s3_lost, s3_tier in rows:
+                    if store_fname:
+                        url = layout.url_for(store_fname, s3_tier)
+                        key = self._s3_key_from_fname(store_fname)
+                        if indexes is None or key[len(prefix):] not in indexes[url]:
+                            by_url.setdefault(url, set()).add(key)
+                heads = dict((url, backends.get(connections[url]).head_many(keys)) for url, keys in by_url.items())
 
+                statuses = []
+                lost_ids, found_ids, unkeyed_ids = [], [], {}
+                for att_id, name, store_fname, s3_key, s3_lost, s3_tier in rows:
+                    status = AuditStatus(name, store_fname)
+                    statuses.append(status)
+                    if not store_fname:
+                        status.error = 'There is no store_fname'
+                        continue
+                    url = layout.url_for(store_fname, s3_tier)
+                    key = self._s3_key_from_fname(store_fname)
+                    error = missing = None
+                    if key in by_url.get(url, ()):
+                        head = heads[url][key]
+                        if isinstance(head, Exception):
+                            missing = is_missing(head)
+                            error = head.response['Error']['Message'] if isinstance(head, ClientError) else str(head)
+                    if missing and staging.get_path(store_fname):
+                        # written behind, waiting for its upload
+                        error = missing = None
+                    if missing:
+                        status.s3_lost = True
+                        status.error = error
+                        totals['lost_count'] += 1
+                        lost_ids.append(att_id)
+                    elif error:
+                        # S3 failed, the object may still be there
+                        _logger.error('S3: check_s3_filestore was not able to check key:%s: %s', key, error)
+                        status.error = error
+                    else:
+                        if s3_lost:
+                            found_ids.append(att_id)
+                        if not s3_key and key == prefix + store_fname:
+                            unkeyed_ids.setdefault(url, []).append(att_id)
+                if lost_ids:
+                    cr.execute("UPDATE ir_attachment SET s3_lost = true WHERE id IN %s", [tuple(lost_ids)])
+                if found_ids:
+                    cr.execute("UPDATE ir_attachment SET s3_lost = false WHERE id IN %s", [tuple(found_ids)])
+                for url, ids in unkeyed_ids.items():
+                    cr.execute("""UPDATE ir_attachment SET s3_key = %s || store_fname, s3_url = %s || store_fname
+                                  WHERE id IN %s""", [prefix, url_prefixes[url], tuple(ids)])
+                for status in statuses:
+                    yield status
+        finally:
+            backends.close()
+            # after an SQL error the cursor went with the transaction, its error goes through
+            if cr._cnx.get_transaction_status() != TRANSACTION_STATUS_INERROR:
+                cr.execute("CLOSE s3_audit")
+            self.invalidate_cache(['s3_key', 's3_url', 's3_lost'])
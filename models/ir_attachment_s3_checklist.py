@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields
+
+
+class S3Checklist(models.Model):
+    """Files to check at the next S3 garbage collection, written by
+    ir.attachment._mark_for_gc and consumed by ir.attachment._file_gc_s3
+    (always through SQL, for speed)
+    """
+    _name = 'ir.attachment.s3.checklist'
+    _description = 'S3 garbage collection checklist'
+    _log_access = False
+
+    store_fname = fields.Char('Stored Filename', required=True, index=True)
+    # written by the INSERT of _mark_for_gc: the table has no magic columns
+    create_date = fields.Datetime('Marked On', index=True)
+    retry_after = fields.Datetime('Retry After', help="Set when the file could not be collected")
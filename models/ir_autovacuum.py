@@ -2,9 +2,13 @@
 # Copyright 2018 OdooGap, Diogo Duarte <dduarte@odoogap.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import logging
+
 from odoo import api, models
 from odoo import SUPERUSER_ID
 
+_logger = logging.getLogger(__name__)
+
 
 class AutoVacuum(models.AbstractModel):
     _inherit = 'ir.autovacuum'
@@ -13,4 +17,12 @@ class AutoVacuum(models.AbstractModel):
     def power_on(self, *args, **kwargs):
         res = super(AutoVacuum, self).power_on(*args, **kwargs)
         self.env['ir.attachment']._file_gc_s3()
+        try:
+            self.env['ir.attachment']._s3_abort_incomplete_uploads()
+        except Exception:
+            _logger.error('S3: was not able to clean up the incomplete multipart uploads', exc_info=True)
+        try:
+            self.env['ir.attachment']._s3_expire_trash()
+        except Exception:
+            _logger.error('S3: was not able to expire the trash', exc_info=True)
         return res
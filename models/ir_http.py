@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+import time
+
+from odoo import models
+from odoo.http import request
+
+from ..tools.metrics import metrics, request_usage
+from .ir_attachment import metrics_directory
+
+_logger = logging.getLogger(__name__)
+
+
+class IrHttp(models.AbstractModel):
+    _inherit = 'ir.http'
+
+    @classmethod
+    def _dispatch(cls):
+        # sums up the S3 requests made while handling the request
+        request_usage.reset()
+        started = time.time()
+        try:
+            return super(IrHttp, cls)._dispatch()
+        finally:
+            if request_usage.calls:
+                _logger.info('S3: %s made %d requests in %.3fs, %d bytes (request %.3fs)',
+                             request.httprequest.path, request_usage.calls, request_usage.seconds,
+                             request_usage.bytes, time.time() - started)
+            metrics.flush(metrics_directory())
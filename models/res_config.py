@@ -20,8 +20,8 @@ class S3ResConfig(models.TransientModel):
         storage = ir_attachment._storage()
         res = {}
         if storage[:5] == 's3://':
-            part, s3_bucket = storage.split('@')
-            part, part1, s3_profile = part.split(':')
+            # the first bucket of the default tier
+            s3_profile, s3_bucket = ir_attachment._parse_storage_url(ir_attachment._s3_layout().urls()[0])[2:4]
             res = {
                 's3_profile': s3_profile,
                 's3_bucket': s3_bucket
@@ -31,10 +31,16 @@ class S3ResConfig(models.TransientModel):
     @api.multi
     def set_default_s3(self, fields=None):
         ir_attachment = self.env['ir.attachment'].browse()
+        current = self.get_default_s3()
+        if current and (current['s3_profile'], current['s3_bucket']) == (self.s3_profile, self.s3_bucket):
+            # unchanged: keep the other buckets and the endpoint of the location
+            if self.s3_load:
+                self.env['ir.attachment'].sudo()._copy_filestore_to_s3()
+            return
         storage = "s3://profile:{s3_profile}@{s3_bucket}".format(s3_profile=self.s3_profile, s3_bucket=self.s3_bucket)
 
         try:
-            s3_bucket = ir_attachment._connect_to_S3_bucket(storage)
+            s3_bucket = ir_attachment._connect_to_S3_bucket(storage, force_check=True)
             self.env['ir.config_parameter'].sudo().set_param('ir_attachment.location', storage)
             if self.s3_load:
                 self.env['ir.attachment'].sudo()._copy_filestore_to_s3()
@@ -50,7 +56,7 @@ class S3ResConfig(models.TransientModel):
             ir_attachment = self.env['ir.attachment'].browse()
             storage = "s3://profile:{s3_profile}@{s3_bucket}".format(s3_profile=wiz.s3_profile, s3_bucket=wiz.s3_bucket)
             try:
-                s3_bucket = ir_attachment._connect_to_S3_bucket(storage)
+                s3_bucket = ir_attachment._connect_to_S3_bucket(storage, force_check=True)
                 _logger.info("S3 bucket connection successful %s", s3_bucket.name)
             except Exception as e:
                 raise AccessError(
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+# Measures the S3 storage engine of an Odoo database, e.g. against a local moto
+# server (pip install moto[server]):
+#
+#   python benchmark_s3.py -c /etc/odoo.conf -d bench_s3 --moto \
+#       --sizes 1KB,1MB,64MB --counts 10,1000 --output results.json
+#
+# or an S3 compatible service with --endpoint http://localhost:9000 --profile minio.
+#
+# The database must have odoo_s3 installed and be dedicated to benchmarks: its
+# storage settings are changed during the run and garbage collected objects
+# stay in the trash of the bucket.
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import boto3
+import botocore
+
+import odoo
+from odoo import api, SUPERUSER_ID
+from odoo.addons.odoo_s3.tools.batch import delete_keys
+from odoo.addons.odoo_s3.tools.layout import DEFAULT_TIER
+from odoo.addons.odoo_s3.tools.listing import iter_objects
+
+_logger = logging.getLogger('benchmark_s3')
+
+UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+SUITES = ('write', 'read', 'check', 'gc', 'migrate')
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    for unit, factor in UNITS.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * factor)
+    return int(value)
+
+
+def human(size):
+    for unit in ('GB', 'MB', 'KB'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return '%d%s' % (size // UNITS[unit], unit)
+    return '%dB' % size
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident memory of the process while a case runs."""
+
+    def __init__(self, interval=0.01):
+        super(RssSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.start_rss = self.peak = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(ratio * (len(values) - 1))))]
+
+
+class Case(object):
+    """Timing of one suite for one size and count. When its operations are
+    timed one by one, the throughput is the one of these operations only, not
+    of the preparation of their payloads."""
+
+    def __init__(self, suite, size, count):
+        self.suite = suite
+        self.size = size
+        self.count = count
+        self.latencies = []
+        self.extra = {}
+
+    def __enter__(self):
+        self.sampler = RssSampler()
+        self.sampler.start()
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.started
+        self.sampler.stop()
+
+    def timed(self, func, *args, **kwargs):
+        started = time.time()
+        result = func(*args, **kwargs)
+        self.latencies.append(time.time() - started)
+        return result
+
+    def result(self):
+        measured = sum(self.latencies) if self.latencies else self.seconds
+        seconds = max(measured, 1e-9)
+        return {
+            'suite': self.suite,
+            'size': self.size,
+            'count': self.count,
+            'seconds': round(measured, 6),
+            'ops_per_s': round(self.count / seconds, 3),
+            'mb_per_s': round(self.size * self.count / seconds / UNITS['MB'], 3),
+            'latency': dict((name, percentile(self.latencies, ratio) and round(percentile(self.latencies, ratio), 6))
+                            for name, ratio in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))),
+            'peak_rss_mb': round(self.sampler.peak / float(UNITS['MB']), 1),
+            'rss_growth_mb': round((self.sampler.peak - self.sampler.start_rss) / float(UNITS['MB']), 1),
+            'extra': self.extra,
+        }
+
+
+class Payloads(object):
+    """Distinct contents of a given size, so that nothing is deduplicated."""
+
+    def __init__(self, run_id, size):
+        self.run_id = run_id
+        self.size = size
+        self.block = os.urandom(min(size, UNITS['MB']))
+
+    def get(self, index):
+        head = ('%s-%d-' % (self.run_id, index)).encode('ascii')
+        repeat = self.size // len(self.block) + 1
+        return (head + self.block * repeat)[:self.size]
+
+
+def start_moto():
+    """Start a moto S3 server on a free port with throw-away credentials, and
+    return the process and its endpoint url."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', 's3', '-p', str(port)],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except socket.error:
+            if process.poll() is not None:
+                raise Exception('moto server exited, is moto[server] installed?')
+            time.sleep(0.2)
+    else:
+        process.kill()
+        raise Exception('moto server did not start')
+    aws_dir = tempfile.mkdtemp(prefix='benchmark_s3')
+    with open(os.path.join(aws_dir, 'credentials'), 'w') as f:
+        f.write('[bench]\naws_access_key_id = testing\naws_secret_access_key = testing\n')
+    with open(os.path.join(aws_dir, 'config'), 'w') as f:
+        f.write('[profile bench]\nregion = us-east-1\n')
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = os.path.join(aws_dir, 'credentials')
+    os.environ['AWS_CONFIG_FILE'] = os.path.join(aws_dir, 'config')
+    return process, 'http://127.0.0.1:%d' % port
+
+
+class Benchmark(object):
+
+    def __init__(self, env, args, run_id):
+        self.env = env
+        self.cr = env.cr
+        self.args = args
+        self.run_id = run_id
+        self.Attachment = env['ir.attachment']
+        self.results = []
+
+    def log(self, result):
+        _logger.info('%-8s %6s x %-7d %9.1f ops/s %9.2f MB/s p50 %s p99 %s peak rss %.1f MB',
+                     result['suite'], human(result['size']), result['count'], result['ops_per_s'],
+                     result['mb_per_s'], result['latency']['p50'], result['latency']['p99'],
+                     result['peak_rss_mb'])
+        self.results.append(result)
+
+    def write(self, size, count):
+        payloads = Payloads(self.run_id, size)
+        fnames = []
+        with Case('write', size, count) as case:
+            for index in range(count):
+                # built one at a time out of the timings, so that large runs fit in memory
+                data = payloads.get(index)
+                value, checksum = base64.b64encode(data), hashlib.sha1(data).hexdigest()
+                del data
+                fnames.append(case.timed(self.Attachment._file_write, value, checksum))
+                del value
+        self.cr.commit()
+        self.log(case.result())
+        return fnames
+
+    def read(self, size, fnames):
+        with Case('read', size, len(fnames)) as case:
+            for fname in fnames:
+                case.timed(self.Attachment._file_read, fname)
+        self.log(case.result())
+
+    def check(self, size, fnames):
+        cr = self.cr
+        cr.execute('SAVEPOINT benchmark_check')
+        cr.execute("""INSERT INTO ir_attachment (name, datas_fname, type, store_fname, file_size,
+                                                 create_uid, write_uid, create_date, write_date)
+                      SELECT 'benchmark', 'benchmark', 'binary', fname, %s, 1, 1,
+                             now() at time zone 'UTC', now() at time zone 'UTC'
+                      FROM unnest(%s) AS fname
+                      RETURNING id""", [size, fnames])
+        attachments = self.Attachment.browse([row[0] for row in cr.fetchall()])
+        modes = [('check_listing', True)]
+        if len(fnames) <= self.args.max_head:
+            modes.insert(0, ('check_head', False))
+        for suite, use_listing in modes:
+            with Case(suite, size, len(fnames)) as case:
+                status, totals = attachments.check_s3_filestore(use_listing=use_listing)
+            case.extra['lost'] = totals.get('lost_count', 0)
+            self.log(case.result())
+        cr.execute('ROLLBACK TO SAVEPOINT benchmark_check')
+        self.Attachment.invalidate_cache()
+
+    def gc(self, size, fnames):
+        for fname in fnames:
+            self.Attachment._mark_for_gc(fname)
+        # the marks are only collected after the grace period
+        self.cr.execute("""UPDATE ir_attachment_s3_checklist
+                           SET create_date = now() at time zone 'UTC' - %s * interval '1 second'
+                           WHERE store_fname IN %s""", [self.Attachment._s3_gc_grace() + 3600, tuple(fnames)])
+        self.cr.commit()
+        with Case('gc', size, len(fnames)) as case:
+            run = self.Attachment._file_gc_s3() or {}
+        self.cr.commit()
+        case.extra.update(run)
+        if run.get('removed', 0) < len(fnames):
+            _logger.warning('gc removed %d of the %d marked files', run.get('removed', 0), len(fnames))
+        self.log(case.result())
+
+    def migrate(self, size, count):
+        get_param = self.env['ir.config_parameter'].get_param
+        set_param = self.env['ir.config_parameter'].set_param
+        copied_to = get_param('ir_attachment.location_s3_copied_to')
+        name = 'benchmark-%s-%s' % (self.run_id, human(size))
+        directory = os.path.join(self.Attachment._filestore(), name)
+        os.makedirs(directory)
+        payloads = Payloads(self.run_id + '-migrate', size)
+        try:
+            for index in range(count):
+                with open(os.path.join(directory, '%08d' % index), 'wb') as f:
+                    f.write(payloads.get(index))
+            set_param('ir_attachment.location_s3_copied_to', False)
+            with Case('migrate', size, count) as case:
+                stats = self.Attachment._run_copy_filestore_to_s3()
+            case.extra.update(stats or {})
+            self.log(case.result())
+        finally:
+            set_param('ir_attachment.location_s3_copied_to', copied_to or False)
+            self.cr.commit()
+            shutil.rmtree(directory, ignore_errors=True)
+            self.remove_copies(name)
+
+    def remove_copies(self, name):
+        """Delete the objects of the ``name`` directory of the filestore
+        copied to the buckets by the migration."""
+        prefix = self.Attachment._s3_key_from_fname(name) + '/'
+        for url in self.Attachment._s3_layout().tiers[DEFAULT_TIER]:
+            connection = self.Attachment._s3_connection(url)
+            keys = [key for key, size in iter_objects(connection.client, connection.bucket_name, prefix)]
+            failed = delete_keys(connection.client, connection.bucket_name, keys)
+            if failed:
+                _logger.warning('%d objects of %s were not deleted from %s', len(failed), prefix,
+                                connection.bucket_name)
+
+    def run(self, sizes, counts, suites):
+        for size in sizes:
+            for count in counts:
+                if size * count > self.args.max_bytes:
+                    _logger.info('skipping %s x %d, over --max-bytes', human(size), count)
+                    continue
+                if set(suites) & set(('write', 'read', 'check', 'gc')):
+                    fnames = self.write(size, count)
+                    if 'read' in suites:
+                        self.read(size, fnames)
+                    if 'check' in suites:
+                        self.check(size, fnames)
+                    if 'gc' in suites:
+                        self.gc(size, fnames)
+                if 'migrate' in suites:
+                    self.migrate(size, count)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = dict(((r['suite'], r['size'], r['count']), r) for r in json.load(f)['results'])
+    for result in results:
+        before = baseline.get((result['suite'], result['size'], result['count']))
+        if not before or not before['ops_per_s']:
+            continue
+        _logger.info('%-8s %6s x %-7d %+7.1f%% ops/s, peak rss %+.1f MB',
+                     result['suite'], human(result['size']), result['count'],
+                     (result['ops_per_s'] / before['ops_per_s'] - 1) * 100,
+                     result['peak_rss_mb'] - before['peak_rss_mb'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the S3 storage engine of an Odoo database.')
+    parser.add_argument('-c', '--config', required=True, help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True, help='database dedicated to the benchmark')
+    parser.add_argument('--moto', action='store_true', help='run against a local moto server')
+    parser.add_argument('--endpoint', help='url of an S3 compatible service')
+    parser.add_argument('--profile', default='default', help='AWS profile (ignored with --moto)')
+    parser.add_argument('--bucket', default='odoo-s3-benchmark', help='bucket name')
+    parser.add_argument('--sizes', default='1KB,64KB,1MB,16MB', help='object sizes, up to e.g. 500MB')
+    parser.add_argument('--counts', default='10,100,1000', help='object counts, up to e.g. 1000000')
+    parser.add_argument('--suites', default=','.join(SUITES), help='among %s' % ', '.join(SUITES))
+    parser.add_argument('--max-bytes', type=parse_size, default=parse_size('2GB'),
+                        help='skip the combinations of size and count above this volume')
+    parser.add_argument('--max-head', type=int, default=10000,
+                        help='largest count checked with one HEAD request per object')
+    parser.add_argument('--output', help='json file for the results (default: stdout)')
+    parser.add_argument('--compare', help='json results of a previous run to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    counts = [int(count) for count in args.counts.split(',')]
+    suites = [suite.strip() for suite in args.suites.split(',')]
+
+    moto = None
+    profile, endpoint = args.profile, args.endpoint
+    if args.moto:
+        moto, endpoint = start_moto()
+        profile = 'bench'
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    odoo.tools.config['s3_endpoint_url'] = endpoint
+    # keep the benchmark output readable
+    logging.getLogger('odoo.addons.odoo_s3').setLevel(logging.WARNING)
+
+    run_id = uuid.uuid4().hex[:8]
+    overrides = {
+        'ir_attachment.location': 's3://profile:%s@%s' % (profile, args.bucket),
+        'ir_attachment.s3_gc_max_keys': str(max(counts) * 2),
+        'ir_attachment.s3_gc_time_budget': str(24 * 3600),
+    }
+    try:
+        registry = odoo.registry(args.database)
+        with api.Environment.manage(), registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            params = env['ir.config_parameter']
+            saved = dict((key, params.get_param(key)) for key in overrides)
+            for key, value in overrides.items():
+                params.set_param(key, value)
+            cr.commit()
+            benchmark = Benchmark(env, args, run_id)
+            started = time.time()
+            try:
+                benchmark.run(sizes, counts, suites)
+            finally:
+                cr.rollback()
+                for key, value in saved.items():
+                    params.set_param(key, value or False)
+                cr.commit()
+    finally:
+        if moto:
+            moto.kill()
+
+    output = {
+        'meta': {
+            'run_id': run_id,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            'seconds': round(time.time() - started, 3),
+            'python': platform.python_version(),
+            'odoo': odoo.release.version,
+            'boto3': boto3.__version__,
+            'botocore': botocore.__version__,
+            'endpoint': 'moto' if args.moto else (endpoint or 'aws'),
+            'host': platform.node(),
+        },
+        'results': benchmark.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if args.compare:
+        compare(benchmark.results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
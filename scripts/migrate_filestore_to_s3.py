@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copies the filestore of a database to S3 without going through Odoo, e.g.:
+#
+#   python migrate_filestore_to_s3.py --profile default --bucket testodoofs1 \
+#       ~/.local/share/Odoo/filestore/v10_odoo_s3
+#
+# Only the files missing in the bucket are sent. If interrupted, running the
+# same command again resumes from the checkpoint file.
+import argparse
+import logging
+import os
+import sys
+
+from boto3.s3.transfer import TransferConfig
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.migrate import FilestoreMigration
+from tools.registry import S3Connection, DEFAULT_OPTIONS
+
+parser = argparse.ArgumentParser(description='Copy an Odoo filestore to an S3 bucket.')
+parser.add_argument('filestore', help='filestore directory of the database')
+parser.add_argument('--profile', default='default', help='AWS profile')
+parser.add_argument('--bucket', required=True, help='bucket name')
+parser.add_argument('--db', help='database name (default: name of the filestore directory)')
+parser.add_argument('--workers', type=int, default=16, help='concurrent uploads')
+parser.add_argument('--checkpoint', help='checkpoint file (default: <filestore>.s3_migration_<bucket>.json)')
+parser.add_argument('--count', action='store_true', help='count the files first, to log an ETA')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+filestore = os.path.abspath(args.filestore)
+db_name = args.db or os.path.basename(filestore.rstrip('/'))
+connection = S3Connection(args.profile, args.bucket, dict(DEFAULT_OPTIONS, max_pool_connections=args.workers))
+connection.ensure_bucket()
+
+migration = FilestoreMigration(
+    connection.client, args.bucket, db_name, filestore,
+    checkpoint=args.checkpoint or filestore.rstrip('/') + '.s3_migration_%s.json' % args.bucket,
+    workers=args.workers, transfer_config=TransferConfig(max_concurrency=4), count_total=args.count)
+stats = migration.run()
+sys.exit(1 if stats['failed'] else 0)
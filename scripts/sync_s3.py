@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copies the files of a database out of S3 without going through Odoo, e.g.:
+#
+#   python sync_s3.py download --profile default --bucket testodoofs1 \
+#       ~/.local/share/Odoo/filestore/v10_odoo_s3
+#
+#   python sync_s3.py copy --profile default --bucket testodoofs1 --db v10_odoo_s3 \
+#       --target-bucket testodoofs2 --target-db v10_odoo_s3_copy
+#
+# Only the files missing in the target are sent, server side between buckets
+# of the same profile. If interrupted, running the same command again resumes
+# from the checkpoint file.
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.registry import S3Connection, DEFAULT_OPTIONS
+from tools.sync import BucketToBucket, BucketToFilestore
+
+parser = argparse.ArgumentParser(description='Copy the files of an Odoo database out of an S3 bucket.')
+parser.add_argument('--profile', default='default', help='AWS profile')
+parser.add_argument('--bucket', required=True, help='bucket name')
+parser.add_argument('--workers', type=int, default=16, help='concurrent transfers')
+parser.add_argument('--checkpoint', help='checkpoint file')
+commands = parser.add_subparsers(dest='command')
+commands.required = True
+download = commands.add_parser('download', help='download the files missing in a local filestore')
+download.add_argument('filestore', help='filestore directory of the database')
+download.add_argument('--db', help='database name (default: name of the filestore directory)')
+copy = commands.add_parser('copy', help='copy the files missing in another bucket or prefix')
+copy.add_argument('--db', required=True, help='database name in the source bucket')
+copy.add_argument('--target-profile', help='AWS profile of the target bucket (default: --profile)')
+copy.add_argument('--target-bucket', help='target bucket name (default: --bucket)')
+copy.add_argument('--target-db', help='database name in the target bucket (default: --db)')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+options = dict(DEFAULT_OPTIONS, max_pool_connections=args.workers)
+source = S3Connection(args.profile, args.bucket, options)
+
+if args.command == 'download':
+    filestore = os.path.abspath(args.filestore)
+    db_name = args.db or os.path.basename(filestore.rstrip('/'))
+    job = BucketToFilestore(
+        source.client, args.bucket, db_name, filestore,
+        checkpoint=args.checkpoint or filestore.rstrip('/') + '.s3_download.json', workers=args.workers)
+else:
+    target_profile = args.target_profile or args.profile
+    target_bucket = args.target_bucket or args.bucket
+    target_db = args.target_db or args.db
+    if (target_bucket, target_db) == (args.bucket, args.db):
+        parser.error('the target is the source')
+    target = S3Connection(target_profile, target_bucket, options)
+    target.ensure_bucket()
+    job = BucketToBucket(
+        source.client, args.bucket, args.db, target.client, target_bucket, target_db,
+        server_side=target_profile == args.profile, workers=args.workers,
+        checkpoint=args.checkpoint or 's3_replication_%s_%s_%s_%s.json' % (args.bucket, args.db, target_bucket,
+                                                                           target_db))
+stats = job.run()
+sys.exit(1 if stats['failed'] else 0)
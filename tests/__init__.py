@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
 import test_ir_attachment
+import test_controllers
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import os
+import time
+
+import requests
+
+from odoo.tests.common import HttpCase, HOST, PORT
+
+
+class TestS3Content(HttpCase):
+    def setUp(self):
+        super(TestS3Content, self).setUp()
+        self.Attachment = self.env['ir.attachment']
+        self.env['ir.config_parameter'].set_param('ir_attachment.s3_serve_mode', 'redirect')
+        self.authenticate('admin', 'admin')
+        self.blob = 'blob content %s %s' % (os.getpid(), time.time())
+
+    def _get(self, attachment):
+        return requests.get('http://%s:%s/web/content/%s' % (HOST, PORT, attachment.id),
+                            cookies={'session_id': self.session_id}, allow_redirects=False, timeout=10)
+
+    def test_01_redirect(self):
+        a20 = self.Attachment.create({'name': 'a20', 'datas': self.blob.encode('base64')})
+        response = self._get(a20)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(a20.s3_key, response.headers['Location'])
+        self.assertEqual(requests.get(response.headers['Location'], timeout=10).content, self.blob)
+
+    def test_02_fallback(self):
+        # a flagged object is read (and checked) by the worker instead
+        a21 = self.Attachment.create({'name': 'a21', 'datas': self.blob.encode('base64')})
+        a21.write({'s3_corrupt': True})
+        response = self._get(a21)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.blob)
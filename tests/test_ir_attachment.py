@@ -2,13 +2,21 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
 import hashlib
+import json
 import os
 import logging
+import tempfile
+import time
 import boto3
 import botocore
 from botocore.exceptions import ClientError
 
 from odoo.tests.common import TransactionCase
+from odoo.tools import config
+from ..tools.backends import ThreadedBackend, is_missing
+from ..tools.breaker import CircuitBreaker
+from ..tools.layout import StorageLayout
+from ..tools.metrics import metrics
 
 
 _logger = logging.getLogger(__name__)
@@ -58,3 +66,311 @@ class TestIrAttachment(TransactionCase):
         s3_key = self._s3_bucket.Object(key)
         self.assertEqual(s3_key.content_type, 'binary/octet-stream', 'Error getting the key:%s' % key)
         self.assertEqual(s3_key.metadata['name'], 'a2', 'Error getting the metadata for key:%s' % key)
+
+    def test_04_dedup_skips_upload(self):
+        self.Attachment.create({'name': 'a4', 'datas': self.blob2_b64})
+        before = self.Attachment._s3_stats()
+        a5 = self.Attachment.create({'name': 'a5', 'datas': self.blob2_b64})
+        after = self.Attachment._s3_stats()
+        self.assertEqual(after.get('uploads', 0), before.get('uploads', 0))
+        self.assertEqual(after['dedup_hits'], before.get('dedup_hits', 0) + 1)
+        self.assertEqual(after['dedup_bytes_saved'], before.get('dedup_bytes_saved', 0) + len(self.blob2))
+        self.assertEqual('%s\n' % a5.datas, self.blob2_b64)
+
+    def test_05_read_through_cache(self):
+        self.env['ir.config_parameter'].set_param('ir_attachment.s3_cache_size', 1024 * 1024)
+        a6 = self.Attachment.create({'name': 'a6', 'datas': self.blob1_b64})
+        a6.invalidate_cache()
+        self.assertEqual('%s\n' % a6.datas, self.blob1_b64)
+        hits = self.Attachment._s3_stats().get('cache_hits', 0)
+        a6.invalidate_cache()
+        self.assertEqual('%s\n' % a6.datas, self.blob1_b64)
+        self.assertEqual(self.Attachment._s3_stats()['cache_hits'], hits + 1)
+
+    def test_06_check_with_listing(self):
+        a7 = self.Attachment.create({'name': 'a7', 'datas': self.blob1_b64})
+        status_head, totals_head = a7.check_s3_filestore(use_listing=False)
+        status_list, totals_list = a7.check_s3_filestore(use_listing=True)
+        self.assertEqual(status_list, status_head)
+        self.assertEqual(totals_list, {'lost_count': 0})
+        self.assertFalse(a7.s3_lost)
+
+    def test_07_prefetch(self):
+        a8 = self.Attachment.create({'name': 'a8', 'datas': self.blob1_b64})
+        a9 = self.Attachment.create({'name': 'a9', 'datas': self.blob2_b64})
+        attachments = a8 | a9
+        attachments.invalidate_cache()
+        fetched = attachments._s3_fetch_many()
+        self.assertEqual(set(fetched), set(attachments.mapped('store_fname')))
+        self.assertEqual(['%s\n' % datas for datas in attachments.mapped('datas')], [self.blob1_b64, self.blob2_b64])
+
+    def test_08_write_behind(self):
+        self.env['ir.config_parameter'].set_param('ir_attachment.s3_write_mode', 'behind')
+        blob = 'blob write behind %s' % os.getpid()
+        a10 = self.Attachment.create({'name': 'a10', 'datas': blob.encode('base64')})
+        staging = self.Attachment._s3_staging()
+        self.assertTrue(staging.get_path(a10.store_fname))
+        a10.invalidate_cache()
+        self.assertEqual(a10.datas.decode('base64'), blob)
+        self.Attachment._s3_drain_staging()
+        self.assertFalse(staging.get_path(a10.store_fname))
+        self.assertEqual(self._s3_bucket.Object(a10.s3_key).get()['Body'].read(), blob)
+
+    def test_09_compression(self):
+        self.env['ir.config_parameter'].set_param('ir_attachment.s3_compress', 'gzip')
+        blob = 'compressible %s\n' % os.getpid() * 1000
+        a11 = self.Attachment.create({'name': 'a11.txt', 'datas_fname': 'a11.txt', 'mimetype': 'text/plain',
+                                      'datas': blob.encode('base64')})
+        s3_object = self._s3_bucket.Object(a11.s3_key)
+        self.assertEqual(s3_object.metadata['codec'], 'gzip')
+        self.assertLess(s3_object.content_length, len(blob))
+        a11.invalidate_cache()
+        self.assertEqual(a11.datas.decode('base64'), blob)
+        stream = a11._s3_stream()
+        self.assertEqual(stream['length'], len(blob))
+        self.assertEqual(''.join(stream['chunks']), blob)
+
+    def test_10_circuit_breaker(self):
+        breaker = CircuitBreaker('test', failure_percent=50, min_calls=4, window=30, open_seconds=0.1)
+        for success in (True, False, True, False):
+            self.assertTrue(breaker.allow())
+            breaker.record(success)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        time.sleep(0.2)
+        # a single probe is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_11_metrics(self):
+        def count(name, **labels):
+            return sum(value for metric, metric_labels, value in metrics.snapshot()['counters']
+                       if metric == name and all(metric_labels.get(k) == v for k, v in labels.items()))
+        puts = count('s3_requests_total', operation='put', outcome='ok')
+        writes = count('s3_writes_total')
+        self.Attachment.create({'name': 'a12', 'datas': ('blob metrics %s' % os.getpid()).encode('base64')})
+        self.assertEqual(count('s3_writes_total'), writes + 1)
+        self.assertGreater(count('s3_requests_total', operation='put', outcome='ok'), puts)
+
+    def test_12_restore_from_trash(self):
+        a13 = self.Attachment.create({'name': 'a13', 'datas': ('blob trash %s' % os.getpid()).encode('base64')})
+        key = a13.s3_key
+        trash_key = self.Attachment._s3_trash_key(a13.store_fname)
+        self._s3_bucket.Object(trash_key).copy_from(CopySource='%s/%s' % (self._s3_bucket.name, key))
+        self._s3_bucket.Object(key).delete()
+        a13.s3_lost = True
+        result = a13._s3_restore_from_trash()
+        self.assertEqual(result['restored'], 1)
+        self.assertFalse(a13.s3_lost)
+        self._s3_bucket.Object(key).load()
+
+    def test_13_layout(self):
+        layout = StorageLayout('s3://profile:default@hot-0,hot-1', {'archive': 's3://profile:default@archive'},
+                               [{'tier': 'archive', 'res_model': 'account.invoice', 'min_age_days': 90}])
+        self.assertEqual(layout.url_for('00/' + '0' * 40), 's3://profile:default@hot-0')
+        self.assertEqual(layout.url_for('00/' + '1' * 40), 's3://profile:default@hot-1')
+        self.assertEqual(layout.url_for('00/' + '1' * 40, 'archive'), 's3://profile:default@archive')
+        self.assertEqual(layout.tier_for('account.invoice', 'application/pdf', 100, 10), 'default')
+        self.assertEqual(layout.tier_for('account.invoice', 'application/pdf', 100, 100), 'archive')
+        # new files are placed by the rules
+        self.env['ir.config_parameter'].set_param('ir_attachment.s3_tiers', '{"tiers": {"archive": "%s"}, '
+                                                  '"rules": [{"tier": "archive", "res_model": "res.partner"}]}'
+                                                  % self.storage)
+        blob = 'blob tier %s %s' % (os.getpid(), time.time())
+        a14 = self.Attachment.create({'name': 'a14', 'res_model': 'res.partner', 'datas': blob.encode('base64')})
+        self.assertEqual(a14.s3_tier, 'archive')
+        a14.invalidate_cache()
+        self.assertEqual(a14.datas.decode('base64'), blob)
+
+    def test_14_audit_report(self):
+        a15 = self.Attachment.create({'name': 'a15', 'datas': ('blob audit %s' % os.getpid()).encode('base64')})
+        report = os.path.join(tempfile.mkdtemp(), 'audit.jsonl')
+        totals = self.Attachment.check_s3_filestore_report(report, [('id', '=', a15.id)], use_listing=False)
+        self.assertEqual(totals['lost_count'], 0)
+        with open(report) as f:
+            statuses = [json.loads(line) for line in f]
+        self.assertEqual(len(statuses), 1)
+        self.assertEqual(statuses[0]['fname'], a15.store_fname)
+        self.assertFalse(statuses[0]['s3_lost'])
+
+    def test_15_corrupt_object(self):
+        blob = 'blob integrity %s %s' % (os.getpid(), time.time())
+        a16 = self.Attachment.create({'name': 'a16', 'datas': blob.encode('base64')})
+        connection = self.Attachment._s3_connection_for(a16.store_fname)
+        connection.client.put_object(Bucket=connection.bucket_name, Key=a16.s3_key, Body='not the blob')
+        a16.invalidate_cache()
+        self.assertNotEqual((a16.datas or '').decode('base64'), 'not the blob')
+        self.assertTrue(a16.s3_corrupt)
+        # the next write of the same content replaces the object
+        self.Attachment.create({'name': 'a17', 'datas': blob.encode('base64')})
+        a16.invalidate_cache()
+        self.assertFalse(a16.s3_corrupt)
+        self.assertEqual(a16.datas.decode('base64'), blob)
+
+    def test_16_copy_from_database(self):
+        blob = 'blob replication %s %s' % (os.getpid(), time.time())
+        a18 = self.Attachment.create({'name': 'a18', 'datas': blob.encode('base64')})
+        connection = self.Attachment._s3_connection_for(a18.store_fname)
+        key = self.Attachment._s3_key_from_fname(a18.store_fname)
+        source_db = 'copy_%s' % os.getpid()
+        source_key = '%s/%s' % (source_db, a18.store_fname)
+        connection.client.copy_object(Bucket=connection.bucket_name, Key=source_key,
+                                      CopySource={'Bucket': connection.bucket_name, 'Key': key})
+        connection.client.delete_object(Bucket=connection.bucket_name, Key=key)
+        try:
+            stats = self.Attachment._s3_copy_from_database(source_db)
+            self.assertEqual(stats['copied'], 1)
+            self.assertEqual(stats['failed'], 0)
+            body = connection.client.get_object(Bucket=connection.bucket_name, Key=key)['Body'].read()
+            self.assertEqual(body, blob)
+        finally:
+            connection.client.delete_object(Bucket=connection.bucket_name, Key=source_key)
+
+    def test_17_tiering_by_age(self):
+        self.env['ir.config_parameter'].set_param('ir_attachment.s3_tiers', '{"tiers": {"archive": "%s"}, '
+                                                  '"rules": [{"tier": "archive", "res_model": "res.partner", '
+                                                  '"min_age_days": 30}]}' % self.storage)
+        blob = 'blob tiering %s %s' % (os.getpid(), time.time())
+        a19 = self.Attachment.create({'name': 'a19', 'res_model': 'res.partner', 'datas': blob.encode('base64')})
+        self.assertEqual(a19.s3_tier, 'default')
+        self.env.cr.execute("UPDATE ir_attachment SET create_date = now() at time zone 'UTC' - interval '60 days' "
+                            "WHERE id = %s", [a19.id])
+        self.assertGreaterEqual(self.Attachment._s3_apply_tiering(), 1)
+        a19.invalidate_cache()
+        self.assertEqual(a19.s3_tier, 'archive')
+        self.assertEqual(a19.datas.decode('base64'), blob)
+
+    def test_18_garbage_collection(self):
+        tag = '%s %s' % (os.getpid(), time.time())
+        garbage = self.Attachment.create({'name': 'a22', 'datas': ('blob garbage %s' % tag).encode('base64')})
+        recent = self.Attachment.create({'name': 'a23', 'datas': ('blob recent %s' % tag).encode('base64')})
+        kept = self.Attachment.create({'name': 'a24', 'datas': ('blob kept %s' % tag).encode('base64')})
+        keys = dict((a.store_fname, a.s3_key) for a in garbage | recent | kept)
+        garbage_fname, recent_fname, kept_fname = garbage.store_fname, recent.store_fname, kept.store_fname
+        (garbage | recent).unlink()
+        self.Attachment._mark_for_gc(kept_fname)
+        self.env.cr.execute("""UPDATE ir_attachment_s3_checklist
+                               SET create_date = now() at time zone 'UTC' - interval '2 days'
+                               WHERE store_fname IN %s""", [(garbage_fname, kept_fname)])
+        self.Attachment._file_gc_s3()
+
+        def exists(key):
+            try:
+                self._s3_bucket.Object(key).load()
+                return True
+            except ClientError:
+                return False
+
+        # the marked file is moved to the trash, the one referenced again and the one marked lately stay
+        self.assertFalse(exists(keys[garbage_fname]))
+        self.assertTrue(exists(self.Attachment._s3_trash_key(garbage_fname)))
+        self.assertTrue(exists(keys[kept_fname]))
+        self.assertTrue(exists(keys[recent_fname]))
+        self.env.cr.execute("SELECT store_fname FROM ir_attachment_s3_checklist WHERE store_fname IN %s",
+                            [tuple(keys)])
+        self.assertEqual([row[0] for row in self.env.cr.fetchall()], [recent_fname])
+
+    def test_19_threaded_backend(self):
+        blob = 'blob backend %s %s' % (os.getpid(), time.time())
+        a25 = self.Attachment.create({'name': 'a25', 'datas': blob.encode('base64')})
+        connection = self.Attachment._s3_connection_for(a25.store_fname)
+        key = a25.s3_key
+        missing = self.Attachment._s3_key_from_fname('00/%s' % ('0' * 40))
+        with ThreadedBackend(connection, 4) as backend:
+            # an invalid key fails on its own, without failing the others
+            fetched = backend.get_many([key, missing, None])
+            self.assertEqual(fetched[key][0], blob)
+            self.assertTrue(is_missing(fetched[missing]))
+            self.assertIsInstance(fetched[None], Exception)
+            self.assertFalse(is_missing(fetched[None]))
+
+            heads = backend.head_many([key, missing, None])
+            self.assertEqual(heads[key]['size'], len(blob))
+            self.assertTrue(is_missing(heads[missing]))
+            self.assertFalse(is_missing(heads[None]))
+
+            # deleting a missing key is not a failure
+            self.assertEqual(backend.delete_many([key, missing]), set())
+            self.assertTrue(is_missing(backend.head_many([key])[key]))
+
+            backend.bucket_name = 'odoo-s3-missing-bucket-%s' % os.getpid()
+            self.assertEqual(backend.delete_many([key]), set([key]))
+
+    def test_20_stream_range(self):
+        blob = 'blob range %s %s' % (os.getpid(), time.time())
+        a26 = self.Attachment.create({'name': 'a26', 'datas': blob.encode('base64')})
+        stream = a26._s3_stream('bytes=2-5')
+        self.assertEqual(stream['content_range'], 'bytes 2-5/%d' % len(blob))
+        self.assertEqual(stream['length'], 4)
+        self.assertEqual(''.join(stream['chunks']), blob[2:6])
+        stream = a26._s3_stream()
+        self.assertIsNone(stream['content_range'])
+        self.assertEqual(''.join(stream['chunks']), blob)
+
+    def test_21_multipart_upload(self):
+        # S3 parts are 5MB at least, but the last one
+        set_param = self.env['ir.config_parameter'].set_param
+        set_param('ir_attachment.s3_multipart_threshold', str(5 * 1024 * 1024))
+        set_param('ir_attachment.s3_multipart_chunksize', str(5 * 1024 * 1024))
+        blob = ('blob multipart %s %s ' % (os.getpid(), time.time())) + os.urandom(11 * 1024 * 1024)
+        a27 = self.Attachment.create({'name': 'a27', 'datas': blob.encode('base64')})
+        s3_object = self._s3_bucket.Object(a27.s3_key)
+        self.assertEqual(s3_object.content_length, len(blob))
+        # the ETag of a multipart upload ends with its number of parts
+        self.assertTrue(s3_object.e_tag.strip('"').endswith('-3'))
+        a27.invalidate_cache()
+        self.assertEqual(a27.datas.decode('base64'), blob)
+
+    def test_22_migration_resume(self):
+        set_param = self.env['ir.config_parameter'].set_param
+        set_param('ir_attachment.location', 'file')
+        blob = 'blob migration %s %s' % (os.getpid(), time.time())
+        a28 = self.Attachment.create({'name': 'a28', 'datas': blob.encode('base64')})
+        fname = a28.store_fname
+        self.assertTrue(os.path.isfile(os.path.join(self.filestore, fname)))
+        set_param('ir_attachment.location', self.storage)
+        set_param('ir_attachment.location_s3_copied_to', False)
+        key = self.Attachment._s3_key_from_fname(fname)
+        s3_object = self._s3_bucket.Object(key)
+
+        # an interrupted run saved that everything up to the file was copied
+        checkpoint = os.path.join(config['data_dir'], 's3_migration_%s_%s.json' % (
+            self.env.cr.dbname, self.Attachment._s3_connection_for(fname).bucket_name))
+        with open(checkpoint, 'w') as f:
+            json.dump({'start_after': fname}, f)
+        self.Attachment._run_copy_filestore_to_s3()
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertRaises(ClientError, s3_object.load)
+
+        set_param('ir_attachment.location_s3_copied_to', False)
+        stats = self.Attachment._run_copy_filestore_to_s3()
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(s3_object.get()['Body'].read(), blob)
+
+    def test_23_write_while_breaker_open(self):
+        self.env['ir.config_parameter'].set_param('ir_attachment.location_s3_copied_to', self.storage)
+        blob = 'blob breaker %s %s' % (os.getpid(), time.time())
+        sha = hashlib.sha1(blob).hexdigest()
+        fname = sha[:HASH_SPLIT] + '/' + sha
+        breaker = self.Attachment._s3_connection_for(fname).breaker
+        breaker._trip(time.time())
+        try:
+            a29 = self.Attachment.create({'name': 'a29', 'datas': blob.encode('base64')})
+            # not in the filestore, which is not read anymore, but staged
+            self.assertFalse(os.path.isfile(os.path.join(self.filestore, fname)))
+            self.assertTrue(self.Attachment._s3_staging().get_path(fname))
+        finally:
+            # the next call probes S3 and closes the breaker
+            breaker.opened_at = 0
+            breaker.allow()
+            breaker.record(True)
+        a29.invalidate_cache()
+        self.assertEqual(a29.datas.decode('base64'), blob)
+        self.Attachment._s3_drain_staging()
+        self.assertFalse(self.Attachment._s3_staging().get_path(fname))
+        a29.invalidate_cache()
+        self.assertEqual(a29.datas.decode('base64'), blob)
+        self.assertFalse(a29.s3_lost)
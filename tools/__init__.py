@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Plain python helpers for the S3 storage engine.
+
+Nothing in this package imports odoo, so the helpers can also be used from
+the standalone scripts shipped with the module.
+"""
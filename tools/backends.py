@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from botocore.exceptions import ClientError
+from concurrent import futures
+
+from .batch import copy_keys, delete_keys
+from .throttle import ByteBudget
+
+
+def is_missing(error):
+    """Tell whether ``error`` means that the object does not exist."""
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+
+class ThreadedBackend(object):
+    """Batch operations on the objects of a bucket, run concurrently by a pool
+    of threads sharing the boto3 client of the connection.
+
+    The ``*_many`` methods return a dict holding, for each item, its result or
+    the exception it raised. Use as a context manager to release the threads.
+    """
+
+    def __init__(self, connection, concurrency):
+        self.connection = connection
+        self.client = connection.client
+        self.bucket_name = connection.bucket_name
+        # the threads share the connection pool of the process
+        self.concurrency = max(1, min(concurrency, connection.options['max_pool_connections']))
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _map(self, func, items):
+        jobs = dict((self.executor.submit(func, item), item) for item in items)
+        results = {}
+        for job in futures.as_completed(jobs):
+            error = job.exception()
+            results[jobs[job]] = job.result() if error is None else error
+        return results
+
+    def get_many(self, keys, sizes=None, max_bytes=None):
+        """Download the objects, with at most ``max_bytes`` bytes in flight
+        according to their expected ``sizes``.
+
+        :return: dict of ``(body, metadata)`` by key
+        """
+        sizes = sizes or {}
+        budget = ByteBudget(max_bytes) if max_bytes else None
+
+        def get(key):
+            size = budget.acquire(sizes.get(key) or 1) if budget else 0
+            try:
+                response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+                return response['Body'].read(), response.get('Metadata', {})
+            finally:
+                if budget:
+                    budget.release(size)
+        return self._map(get, keys)
+
+    def head_many(self, keys):
+        """:return: dict of ``{'size', 'metadata'}`` by key"""
+        def head(key):
+            response = self.client.head_object(Bucket=self.bucket_name, Key=key)
+            return {'size': response['ContentLength'], 'metadata': response.get('Metadata', {})}
+        return self._map(head, keys)
+
+    def copy_many(self, pairs):
+        """Copy the ``(source_key, target_key)`` pairs inside the bucket.
+
+        :return: the lists of pairs copied, whose source is missing and failed
+        """
+        return copy_keys(self.executor, self.client, self.bucket_name, pairs)
+
+    def delete_many(self, keys):
+        """:return: the set of keys that could not be deleted"""
+        return delete_keys(self.client, self.bucket_name, keys)
+
+
+class Backends(object):
+    """The batch backends of several connections, created on first use and
+    closed together."""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._backends = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, connection):
+        backend = self._backends.get(connection)
+        if backend is None:
+            backend = self._backends[connection] = ThreadedBackend(connection, self.concurrency)
+        return backend
+
+    def close(self):
+        backends, self._backends = self._backends, {}
+        for backend in backends.values():
+            backend.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from botocore.exceptions import ClientError
+from concurrent import futures
+
+from .integrity import check_upload
+
+_logger = logging.getLogger(__name__)
+
+# maximum number of keys of a DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+
+def _copy(client, bucket_name, source_key, target_key):
+    client.copy_object(Bucket=bucket_name, Key=target_key,
+                       CopySource={'Bucket': bucket_name, 'Key': source_key})
+
+
+def copy_keys(executor, client, bucket_name, pairs):
+    """Copy the ``(source_key, target_key)`` pairs inside the bucket, in
+    parallel on ``executor``.
+
+    :return: three lists of pairs: the copied ones, the ones whose source does
+             not exist and the ones that failed
+    """
+    jobs = dict((executor.submit(_copy, client, bucket_name, source, target), (source, target))
+                for source, target in pairs)
+    copied, missing, failed = [], [], []
+    for job in futures.as_completed(jobs):
+        pair = jobs[job]
+        error = job.exception()
+        if error is None:
+            copied.append(pair)
+        elif isinstance(error, ClientError) and error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            missing.append(pair)
+        else:
+            _logger.error('S3: was not able to copy key:%s to key:%s: %s', pair[0], pair[1], error)
+            failed.append(pair)
+    return copied, missing, failed
+
+
+def delete_keys(client, bucket_name, keys):
+    """Delete ``keys`` with as few DeleteObjects requests as possible.
+
+    :return: the set of keys that could not be deleted
+    """
+    keys = list(keys)
+    failed = set()
+    for index in range(0, len(keys), DELETE_BATCH_SIZE):
+        chunk = keys[index:index + DELETE_BATCH_SIZE]
+        try:
+            response = client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': key} for key in chunk],
+                'Quiet': True,
+            })
+        except ClientError as ex:
+            _logger.error('S3: was not able to delete %d keys: %s', len(chunk), ex)
+            failed.update(chunk)
+            continue
+        for error in response.get('Errors', []):
+            _logger.error('S3: was not able to delete key:%s %s:%s', error['Key'], error['Code'], error['Message'])
+            failed.add(error['Key'])
+    return failed
+
+
+def transfer_object(source_client, source_bucket, source_key, target_client, target_bucket, target_key,
+                    server_side=True):
+    """Copy an object to another bucket or key: server side when
+    ``server_side`` (same credentials and endpoint), else streamed from a
+    download to an upload. Its metadata is kept.
+
+    :return: the size of the object, when known
+    """
+    if server_side:
+        target_client.copy_object(Bucket=target_bucket, Key=target_key,
+                                  CopySource={'Bucket': source_bucket, 'Key': source_key}, MetadataDirective='COPY')
+        return None
+    response = source_client.get_object(Bucket=source_bucket, Key=source_key)
+    try:
+        target_client.upload_fileobj(response['Body'], target_bucket, target_key,
+                                     ExtraArgs={'Metadata': response.get('Metadata', {})})
+    finally:
+        response['Body'].close()
+    check_upload(target_client, target_bucket, target_key, response['ContentLength'])
+    return response['ContentLength']
+
+
+def transfer_keys(executor, source_client, source_bucket, target_client, target_bucket, keys, server_side=True):
+    """Copy ``keys`` from a bucket to another one, in parallel on ``executor``:
+    server side when ``server_side`` (same credentials and endpoint), else
+    streamed from a download to an upload.
+
+    :return: three lists of keys: the copied ones, the ones missing in the
+             source bucket and the ones that failed
+    """
+    jobs = dict((executor.submit(transfer_object, source_client, source_bucket, key, target_client, target_bucket,
+                                 key, server_side), key)
+                for key in keys)
+    copied, missing, failed = [], [], []
+    for job in futures.as_completed(jobs):
+        key = jobs[job]
+        error = job.exception()
+        if error is None:
+            copied.append(key)
+        elif isinstance(error, ClientError) and error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            missing.append(key)
+        else:
+            _logger.error('S3: was not able to copy key:%s from %s to %s: %s', key, source_bucket, target_bucket, error)
+            failed.append(key)
+    return copied, missing, failed
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import collections
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Process wide circuit breaker.
+
+    The outcome of the calls of the last ``window`` seconds is recorded; a call
+    failing or lasting more than ``slow_call`` seconds counts as a failure.
+    Once there are ``min_calls`` calls and ``failure_percent`` of them failed,
+    the breaker opens: ``allow()`` returns False for ``open_seconds``, then a
+    single probe call is let through, whose outcome closes or reopens it.
+    """
+
+    def __init__(self, name, failure_percent=50, min_calls=10, window=30, open_seconds=30, slow_call=10):
+        self.name = name
+        self.failure_percent = failure_percent
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.slow_call = slow_call
+        self.state = CLOSED
+        self.opened_at = 0
+        self.trips = 0
+        self._calls = collections.deque()
+        self._failures = 0
+        self._probe_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            if self.state == OPEN:
+                if now - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_at = 0
+            # a probe that made no call at all must not block the others forever
+            if self._probe_at and now - self._probe_at < self.open_seconds:
+                return False
+            self._probe_at = now
+            return True
+
+    def record(self, success, elapsed=0.0):
+        failed = not success or elapsed > self.slow_call
+        with self._lock:
+            now = time.time()
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._trip(now)
+                else:
+                    _logger.info('S3: circuit breaker %s closed', self.name)
+                    self.state = CLOSED
+                    self._calls.clear()
+                    self._failures = 0
+                return
+            elif self.state == OPEN:
+                return
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._failures -= self._calls.popleft()[1]
+            if len(self._calls) >= self.min_calls \
+                    and self._failures * 100 >= self.failure_percent * len(self._calls):
+                self._trip(now)
+
+    def _trip(self, now):
+        _logger.warning('S3: circuit breaker %s opened (%d/%d calls failed), failing fast for %ds',
+                        self.name, self._failures, len(self._calls), self.open_seconds)
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._calls.clear()
+        self._failures = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'trips': self.trips,
+                'calls': len(self._calls),
+                'failures': self._failures,
+            }
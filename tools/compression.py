@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# gzip framing, so that browsers can decode it as a Content-Encoding
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_TYPES = set([
+    'application/csv',
+    'application/javascript',
+    'application/json',
+    'application/postscript',
+    'application/rtf',
+    'application/x-javascript',
+    'application/x-yaml',
+    'application/xml',
+    'image/svg+xml',
+])
+
+
+def is_compressible(mimetype):
+    """Tell whether content of this mimetype is worth compressing: text and
+    structured formats are, images, archives and office documents are already
+    compressed."""
+    mimetype = (mimetype or '').split(';')[0].strip().lower()
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES \
+        or mimetype.endswith('+xml') or mimetype.endswith('+json')
+
+
+def available(codec):
+    return codec == 'gzip' or (codec == 'zstd' and zstandard is not None)
+
+
+def compress(data, codec):
+    if codec == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError('Unsupported codec %r' % codec)
+
+
+def _decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(GZIP_WBITS)
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unsupported codec %r' % codec)
+
+
+def decode(data, metadata):
+    """Return the original content of an object body, given its metadata."""
+    codec = (metadata or {}).get('codec')
+    if not codec:
+        return data
+    return b''.join(iter_decompress([data], codec))
+
+
+def iter_decompress(chunks, codec):
+    """Decompress an iterator of chunks, without holding the whole content."""
+    decompressor = _decompressor(codec)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if codec == 'gzip':
+        data = decompressor.flush()
+        if data:
+            yield data
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import errno
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .stats import Counters
+
+_logger = logging.getLogger(__name__)
+
+# once over a cap, evict down to this ratio of it
+LOW_WATER = 0.9
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class DiskCache(object):
+    """LRU cache of immutable objects on disk, capped in size and in number of
+    entries, that can be shared by several processes.
+
+    Entries are written in a temporary file renamed in place, so a reader never
+    sees a partial entry. A hit refreshes the modification time of the entry,
+    which is what the eviction sorts on. Evictions are serialized between the
+    processes with a lock file; a process finding it taken simply skips its turn.
+
+    The size of the cache is tracked from the last scan and the writes of the
+    process since then; the scans and evictions run in a background thread,
+    never in the one of the request writing the entry.
+    """
+
+    def __init__(self, directory, max_size, max_entries, scan_interval=60):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.scan_interval = scan_interval
+        self.stats = Counters()
+        self._lock = threading.Lock()
+        self._last_scan = 0
+        self._written = 0
+        self._written_entries = 0
+        # size and number of entries found by the last scan
+        self._size = 0
+        self._entries = 0
+        self._evicting = False
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def get_path(self, key):
+        """Return the path of the entry for ``key`` if it is cached, else None."""
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            self.stats.incr('misses')
+            return None
+        self.stats.incr('hits')
+        return path
+
+    def get(self, key):
+        """Return the content cached for ``key``, or None."""
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            # evicted in between
+            return None
+        self.stats.incr('bytes_served', len(data))
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        tmp_path = None
+        try:
+            _makedirs(dirname)
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            _logger.warning('S3: cache was not able to store key:%s', key, exc_info=True)
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return False
+        self.stats.incr('writes')
+        self.stats.incr('bytes_written', len(data))
+        self._maybe_evict(len(data))
+        return True
+
+    def _maybe_evict(self, size):
+        with self._lock:
+            self._written += size
+            self._written_entries += 1
+            now = time.time()
+            over = (self._size + self._written > self.max_size
+                    or self._entries + self._written_entries > self.max_entries)
+            if self._evicting or not over and self._written < self.max_size * (1 - LOW_WATER) \
+                    and now - self._last_scan < self.scan_interval:
+                return
+            self._evicting = True
+            self._written = self._written_entries = 0
+            self._last_scan = now
+        thread = threading.Thread(target=self._evict_in_background, name='s3 cache eviction')
+        thread.daemon = True
+        thread.start()
+
+    def _evict_in_background(self):
+        try:
+            self.evict()
+        except Exception:
+            _logger.warning('S3: cache was not able to evict entries from %s', self.directory, exc_info=True)
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is back under
+        its caps. Return the number of evicted entries."""
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return 0
+            try:
+                return self._evict()
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        stale = time.time() - 3600
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    if name.startswith('.tmp') and st.st_mtime < stale:
+                        # left behind by a killed worker
+                        os.unlink(path)
+                except OSError:
+                    continue
+                if name.startswith('.'):
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+        count = len(entries)
+        if total_size <= self.max_size and count <= self.max_entries:
+            self._scanned(total_size, count)
+            return 0
+
+        max_size = self.max_size * LOW_WATER
+        max_entries = self.max_entries * LOW_WATER
+        evicted = 0
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= max_size and count <= max_entries:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_size -= size
+            count -= 1
+            evicted += 1
+        self._scanned(total_size, count)
+        self.stats.incr('evictions', evicted)
+        _logger.debug('S3: cache evicted %d entries from %s', evicted, self.directory)
+        return evicted
+
+    def _scanned(self, size, entries):
+        with self._lock:
+            self._size = size
+            self._entries = entries
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(directory, max_size, max_entries):
+    """Return the :class:`DiskCache` of this process for these settings."""
+    key = (directory, max_size, max_entries)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                _makedirs(directory)
+                cache = _caches[key] = DiskCache(directory, max_size, max_entries)
+    return cache
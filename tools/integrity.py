@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import hashlib
+
+from botocore.exceptions import ClientError
+
+from .listing import SHA_FNAME
+from .streams import CHUNK_SIZE
+
+
+class CorruptObject(Exception):
+    """Raised when the content of an object does not match the SHA1 of its
+    file name."""
+
+
+def expected_sha1(fname):
+    """The SHA1 of the content of ``fname`` (``xx/<sha1>``), None for other
+    names."""
+    match = SHA_FNAME.match(fname or '')
+    return match.group(1) if match else None
+
+
+def content_md5(body):
+    """Value of the Content-MD5 header of ``body`` (bytes or a seekable file
+    read in chunks and rewound), checked by S3 on upload."""
+    digest = hashlib.md5()
+    if hasattr(body, 'read'):
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        body.seek(0)
+    else:
+        digest.update(body)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def check_upload(client, bucket_name, key, size):
+    """Make sure the object uploaded to ``key`` in parts has the ``size`` of
+    its content: else remove it and raise :class:`CorruptObject`, a multipart
+    upload having no Content-MD5 of the whole object."""
+    stored = client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+    if stored == size:
+        return
+    try:
+        client.delete_object(Bucket=bucket_name, Key=key)
+    except ClientError:
+        pass
+    raise CorruptObject('%s was stored with %d bytes instead of %d' % (key, stored, size))
+
+
+def verify(data, fname):
+    """Raise :class:`CorruptObject` if ``data`` is not the content of ``fname``."""
+    sha = expected_sha1(fname)
+    if sha and hashlib.sha1(data).hexdigest() != sha:
+        raise CorruptObject('%s does not match its SHA1 (%d bytes read)' % (fname, len(data)))
+
+
+def sha1_of(chunks):
+    """:return: the SHA1 (hex) and the size of the content of ``chunks``"""
+    digest = hashlib.sha1()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def iter_verified(chunks, fname):
+    """Pass ``chunks`` through, hashing them on the way: once the last one is
+    handed out, raise :class:`CorruptObject` if the content does not match
+    ``fname``."""
+    sha = expected_sha1(fname)
+    digest = hashlib.sha1()
+    size = 0
+    for chunk in chunks:
+        if sha:
+            digest.update(chunk)
+            size += len(chunk)
+        yield chunk
+    if sha and digest.hexdigest() != sha:
+        raise CorruptObject('%s does not match its SHA1 (%d bytes read)' % (fname, size))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import fnmatch
+import json
+import zlib
+
+DEFAULT_TIER = 'default'
+
+
+def split_location(location):
+    """Split a storage location into the urls of its buckets.
+
+    A location holds one or several urls separated by spaces, each one with
+    one or several buckets separated by commas and an optional endpoint:
+    ``s3://profile:aws@odoo-0,odoo-1 s3://profile:minio@odoo?endpoint=http://minio:9000``
+    gives ``s3://profile:aws@odoo-0``, ``s3://profile:aws@odoo-1`` and
+    ``s3://profile:minio@odoo?endpoint=http://minio:9000``.
+    """
+    urls = []
+    for part in location.split():
+        base, sep, query = part.partition('?')
+        head, at, buckets = base.rpartition('@')
+        if not at:
+            raise ValueError('Unable to parse the S3 bucket url %r.' % part)
+        for bucket in buckets.split(','):
+            if bucket:
+                urls.append('%s@%s%s%s' % (head, bucket, sep, query))
+    if not urls:
+        raise ValueError('No S3 bucket in %r.' % location)
+    return urls
+
+
+def shard_of(fname, count):
+    """Index of the bucket of ``fname`` among ``count`` ones, from the leading
+    digits of its SHA1 (uniformly distributed)."""
+    if count == 1:
+        return 0
+    sha = fname.rsplit('/', 1)[-1]
+    try:
+        value = int(sha[:8], 16)
+    except ValueError:
+        value = zlib.crc32(sha.encode('utf-8')) & 0xffffffff
+    return value % count
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _match(rule, res_model, mimetype, size, age_days):
+    models = _as_list(rule.get('res_model'))
+    if models and res_model not in models:
+        return False
+    mimetypes = _as_list(rule.get('mimetype'))
+    if mimetypes and not any(fnmatch.fnmatch(mimetype or '', pattern) for pattern in mimetypes):
+        return False
+    if 'min_size' in rule and (size or 0) < rule['min_size']:
+        return False
+    if 'max_size' in rule and (size or 0) > rule['max_size']:
+        return False
+    if 'min_age_days' in rule and age_days < rule['min_age_days']:
+        return False
+    if 'max_age_days' in rule and age_days > rule['max_age_days']:
+        return False
+    return True
+
+
+class StorageLayout(object):
+    """Where the files of a database are stored.
+
+    A tier is a list of buckets and a file goes to the bucket of its tier
+    picked by its SHA1, spreading the requests over the buckets. The default
+    tier comes from ``location``, the others from ``tiers`` (name: location).
+    The ``rules`` choose the tier of a file from its attachment, the first
+    matching one wins: ``{"tier": "archive", "res_model": ["account.move"],
+    "mimetype": "application/*", "min_size": 0, "max_size": 1048576,
+    "min_age_days": 90, "max_age_days": 365}``, all criteria optional.
+
+    The buckets of a tier must not change once files were written there:
+    define a new tier and move the files to it instead.
+    """
+
+    def __init__(self, location, tiers=None, rules=None):
+        self.tiers = {DEFAULT_TIER: split_location(location)}
+        for name, tier_location in (tiers or {}).items():
+            self.tiers[name] = split_location(tier_location)
+        self.rules = rules or []
+        for rule in self.rules:
+            if rule.get('tier') not in self.tiers:
+                raise ValueError('Unknown S3 tier %r in the rule %r.' % (rule.get('tier'), rule))
+
+    @property
+    def tiered(self):
+        return len(self.tiers) > 1
+
+    def urls(self):
+        """All the bucket urls, the ones of the default tier first."""
+        urls = list(self.tiers[DEFAULT_TIER])
+        for name in sorted(self.tiers):
+            urls.extend(url for url in self.tiers[name] if url not in urls)
+        return urls
+
+    def url_for(self, fname, tier=None):
+        """Url of the bucket holding ``fname`` in ``tier`` (the default one
+        for None or a tier that is not configured anymore)."""
+        urls = self.tiers.get(tier or DEFAULT_TIER) or self.tiers[DEFAULT_TIER]
+        return urls[shard_of(fname, len(urls))]
+
+    def urls_for(self, fname):
+        """Urls of the buckets that may hold ``fname``, one per tier."""
+        urls = []
+        for name in [DEFAULT_TIER] + sorted(self.tiers):
+            url = self.url_for(fname, name)
+            if url not in urls:
+                urls.append(url)
+        return urls
+
+    def tier_for(self, res_model=None, mimetype=None, size=None, age_days=0):
+        """Tier of a file according to the rules."""
+        for rule in self.rules:
+            if _match(rule, res_model, mimetype, size, age_days):
+                return rule['tier']
+        return DEFAULT_TIER
+
+
+_layouts = {}
+
+
+def get_layout(location, tiers_config=None):
+    """The :class:`StorageLayout` of a location and of the json configuration
+    of its tiers (``{"tiers": {...}, "rules": [...]}``), parsed once."""
+    key = (location, tiers_config or '')
+    layout = _layouts.get(key)
+    if layout is None:
+        config = json.loads(tiers_config) if tiers_config else {}
+        layout = StorageLayout(location, config.get('tiers'), config.get('rules'))
+        if len(_layouts) >= 16:
+            _layouts.clear()
+        _layouts[key] = layout
+    return layout
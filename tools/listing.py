@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import binascii
+import re
+
+
+def iter_objects(client, bucket_name, prefix, start_after=None, page_size=1000, modified_before=None):
+    """Yield the objects under ``prefix`` as ``(key, size)``, in key order, one
+    ListObjectsV2 page at a time. With ``modified_before`` (an aware datetime),
+    only the objects last modified before it are yielded."""
+    params = {'Bucket': bucket_name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': page_size}}
+    if start_after:
+        params['StartAfter'] = start_after
+    for page in client.get_paginator('list_objects_v2').paginate(**params):
+        for obj in page.get('Contents', []):
+            if modified_before is None or obj['LastModified'] < modified_before:
+                yield obj['Key'], obj['Size']
+
+
+def iter_files(client, bucket_name, prefix, start_after=None):
+    """Yield the objects of the ``xx/`` directories under ``prefix`` as ``(key,
+    size)``, in key order, so that the other ones (``trash/``,
+    ``checklist/``) are never listed."""
+    directories = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        directories.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    for directory in sorted(directories):
+        if not SHA_DIRECTORY.match(directory[len(prefix):]):
+            continue
+        if start_after and start_after[:len(directory)] > directory:
+            continue
+        for item in iter_objects(client, bucket_name, directory,
+                                 start_after=start_after if start_after and start_after > directory else None):
+            yield item
+
+
+def iter_names(client, bucket_name, prefix, start_after=''):
+    """Yield the names of the objects under ``prefix``, relative to it and in
+    key order, after the ``start_after`` name."""
+    listing = iter_objects(client, bucket_name, prefix, start_after=prefix + start_after if start_after else None)
+    for key, size in listing:
+        yield key[len(prefix):]
+
+
+SHA_FNAME = re.compile(r'^[0-9a-f]{2}/([0-9a-f]{40})$')
+SHA_DIRECTORY = re.compile(r'^[0-9a-f]{2}/$')
+DIGEST_SIZE = 20
+
+
+class DigestSet(object):
+    """Compact set of SHA1 digests: 20 bytes per digest in one sorted buffer,
+    searched by bisection."""
+
+    def __init__(self, digests):
+        buf = bytearray()
+        last = None
+        ordered = True
+        for digest in digests:
+            if last is not None and digest < last:
+                ordered = False
+            buf.extend(digest)
+            last = digest
+        data = bytes(buf)
+        del buf
+        if not ordered:
+            data = b''.join(sorted(data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)))
+        self._data = data
+        self._len = len(data) // DIGEST_SIZE
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, digest):
+        data = self._data
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = data[mid * DIGEST_SIZE:(mid + 1) * DIGEST_SIZE]
+            if value < digest:
+                lo = mid + 1
+            elif value > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+
+class KeyIndex(object):
+    """Membership index of the ``xx/<sha1>`` file names stored under a prefix,
+    built from its listing and kept as packed digests. Any other name is left
+    out: it is not in the index."""
+
+    def __init__(self, keys, prefix):
+
+        def digests():
+            for key in keys:
+                match = SHA_FNAME.match(key[len(prefix):])
+                if match:
+                    yield binascii.unhexlify(match.group(1))
+
+        self.digests = DigestSet(digests())
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __contains__(self, fname):
+        match = SHA_FNAME.match(fname)
+        return bool(match) and binascii.unhexlify(match.group(1)) in self.digests
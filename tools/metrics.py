@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .diskcache import _makedirs
+
+_logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# counters of the dead processes, in the directory of the snapshots
+AGGREGATE = 'aggregate.json'
+
+HELP = {
+    's3_requests_total': 'S3 requests by operation and outcome.',
+    's3_request_seconds': 'Latency of the S3 requests by operation.',
+    's3_bytes_total': 'Bytes received from (in) and sent to (out) S3.',
+    's3_reads_total': 'Attachment reads by outcome.',
+    's3_writes_total': 'Attachment writes by outcome.',
+    's3_gc_keys_total': 'Keys checked and removed by the garbage collection.',
+    's3_trash_keys_total': 'Keys expired from and restored out of the trash.',
+    's3_trash_bytes_total': 'Bytes expired from and restored out of the trash.',
+    's3_scrub_objects_total': 'Objects checked by the scrubber by result.',
+    's3_scrub_bytes_total': 'Bytes read by the scrubber.',
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    """Counters and latency histograms of a process, labelled like Prometheus
+    metrics. A forked child starts from zero."""
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._name = _snapshot_name(self._pid)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._name = _snapshot_name(self._pid)
+            self._lock = threading.Lock()
+            self._counters = {}
+            self._histograms = {}
+            self._flushed_at = 0
+
+    def incr(self, name, value=1, **labels):
+        self._check_fork()
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        self._check_fork()
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def snapshot(self):
+        self._check_fork()
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, dict(labels), list(values)]
+                               for (name, labels), values in self._histograms.items()],
+            }
+
+    def flush(self, directory, interval=10, force=False):
+        """Write the snapshot of this process in ``directory`` for
+        :func:`collect`, at most once every ``interval`` seconds."""
+        self._check_fork()
+        now = time.time()
+        if not force and now - self._flushed_at < interval:
+            return
+        self._flushed_at = now
+        tmp_path = None
+        try:
+            _makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.rename(tmp_path, os.path.join(directory, self._name))
+        except (IOError, OSError):
+            _logger.warning('S3: was not able to write the metrics in %s', directory, exc_info=True)
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+def _snapshot_name(pid):
+    # unique even when the pid is reused by a later process
+    return '%d-%d.json' % (pid, int(time.time() * 1000))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _add(counters, histograms, snapshot):
+    for metric, labels, value in snapshot['counters']:
+        key = (metric, _labels_key(labels))
+        counters[key] = counters.get(key, 0) + value
+    for metric, labels, values in snapshot['histograms']:
+        key = (metric, _labels_key(labels))
+        total = histograms.setdefault(key, [0] * len(values))
+        for index, value in enumerate(values):
+            total[index] += value
+
+
+def _as_snapshot(counters, histograms):
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, dict(labels), values] for (name, labels), values in histograms.items()],
+    }
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _dead_snapshots(names):
+    """The snapshots of the processes that are gone: their pid is not alive
+    or a later process got the same pid."""
+    latest = {}
+    for name in names:
+        pid, started = (int(part) for part in name[:-5].split('-'))
+        latest[pid] = max(latest.get(pid, started), started)
+    dead = []
+    for name in names:
+        pid, started = (int(part) for part in name[:-5].split('-'))
+        if started < latest[pid] or not _alive(pid):
+            dead.append(name)
+    return dead
+
+
+def _fold(directory, names):
+    """Add the snapshots ``names`` of dead processes to the aggregate and
+    remove them, so that the sums never go down. The aggregate remembers
+    the snapshots it holds, a snapshot is never added twice."""
+    path = os.path.join(directory, AGGREGATE)
+    try:
+        aggregate = _load(path)
+    except (IOError, OSError, ValueError):
+        aggregate = {'counters': [], 'histograms': [], 'folded': []}
+    counters, histograms = {}, {}
+    _add(counters, histograms, aggregate)
+    # the folded snapshots that are gone for good are forgotten
+    remaining = set(os.listdir(directory))
+    folded = set(name for name in aggregate.get('folded', []) if name in remaining)
+    for name in names:
+        if name in folded:
+            continue
+        try:
+            _add(counters, histograms, _load(os.path.join(directory, name)))
+        except (IOError, OSError, ValueError):
+            continue
+        folded.add(name)
+    aggregate = _as_snapshot(counters, histograms)
+    aggregate['folded'] = sorted(folded)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(aggregate, f)
+    os.rename(tmp_path, path)
+    for name in names:
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def collect(directory):
+    """Sum the snapshots written by all the processes in ``directory``, the
+    ones of the dead processes being folded in a persistent aggregate first
+    (under a lock, when fcntl is available)."""
+    counters = {}
+    histograms = {}
+    try:
+        names = [name for name in os.listdir(directory)
+                 if re.match(r'^\d+-\d+\.json$', name)]
+    except OSError:
+        return counters, histograms
+    dead = _dead_snapshots(names)
+    if dead:
+        try:
+            with open(os.path.join(directory, '.lock'), 'a') as lock:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                _fold(directory, [name for name in dead if os.path.exists(os.path.join(directory, name))])
+        except (IOError, OSError):
+            _logger.warning('S3: was not able to fold the metrics of the dead processes in %s', directory,
+                            exc_info=True)
+    for name in os.listdir(directory):
+        if name != AGGREGATE and not re.match(r'^\d+-\d+\.json$', name):
+            continue
+        try:
+            _add(counters, histograms, _load(os.path.join(directory, name)))
+        except (IOError, OSError, ValueError):
+            continue
+    return counters, histograms
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in items)
+
+
+def render(collected):
+    """Format the result of :func:`collect` in the Prometheus text format."""
+    counters, histograms = collected
+    lines = []
+    for metric in sorted(set(name for name, labels in counters)):
+        lines.append('# HELP %s %s' % (metric, HELP.get(metric, metric)))
+        lines.append('# TYPE %s counter' % metric)
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric:
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    for metric in sorted(set(name for name, labels in histograms)):
+        lines.append('# HELP %s %s' % (metric, HELP.get(metric, metric)))
+        lines.append('# TYPE %s histogram' % metric)
+        for (name, labels), values in sorted(histograms.items()):
+            if name != metric:
+                continue
+            for bound, value in zip(BUCKETS, values):
+                lines.append('%s_bucket%s %s' % (name, _format_labels(labels, le=bound), value))
+            lines.append('%s_bucket%s %s' % (name, _format_labels(labels, le='+Inf'), values[-1]))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), values[-2]))
+            lines.append('%s_count%s %s' % (name, _format_labels(labels), values[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class RequestUsage(threading.local):
+    """S3 time, requests and bytes of the HTTP request handled by the thread."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, nbytes=0):
+        self.calls += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+
+
+metrics = Metrics()
+request_usage = RequestUsage()
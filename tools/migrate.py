@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent import futures
+
+from .integrity import check_upload, content_md5
+from .listing import iter_names
+
+_logger = logging.getLogger(__name__)
+
+
+def walk_sorted(root, start_after='', rel=''):
+    """Yield the paths of the files under ``root``, relative to it and with '/'
+    separators, in the order S3 lists keys. Paths up to ``start_after`` are
+    skipped without walking the directories holding them."""
+    try:
+        names = os.listdir(os.path.join(root, rel))
+    except OSError:
+        return
+    entries = []
+    for name in names:
+        is_dir = os.path.isdir(os.path.join(root, rel, name))
+        # sorting 'ab/' instead of 'ab' keeps the order of the full paths
+        entries.append((name + '/' if is_dir else name, is_dir))
+    entries.sort()
+    for sort_name, is_dir in entries:
+        path = rel + sort_name
+        if is_dir:
+            if start_after.startswith(path) or path > start_after:
+                for sub_path in walk_sorted(root, start_after, path):
+                    yield sub_path
+        elif path > start_after:
+            yield path
+
+
+class SortedTransfer(object):
+    """Copy the files of a source missing in a target.
+
+    Subclasses list the names of both sides in the order S3 lists keys, and
+    the two listings are merged, so memory does not depend on the number of
+    files. Copies run on a bounded thread pool. The last name below which
+    everything is copied is saved in the ``checkpoint`` json file, from where
+    an interrupted run resumes. With ``accept``, only the names it returns
+    True for are copied. With ``count_total``, the source is listed a first
+    time to count its files, so that the progress reports have an ETA.
+    """
+    # what the logs call the job
+    label = 'transfer'
+
+    def __init__(self, checkpoint=None, workers=16, report_interval=30, checkpoint_interval=10, accept=None,
+                 count_total=False):
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.report_interval = report_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.accept = accept
+        self.count_total = count_total
+        self.stats = {'total': 0, 'checked': 0, 'skipped': 0, 'copied': 0, 'bytes': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._done = set()
+        self.watermark = ''
+
+    def iter_source(self, start_after=''):
+        """Yield the ``(name, size)`` of the source after ``start_after``, the
+        size being None when unknown."""
+        raise NotImplementedError()
+
+    def iter_target(self, start_after=''):
+        """Yield the names of the target after ``start_after``."""
+        raise NotImplementedError()
+
+    def copy(self, name, size):
+        """Copy ``name`` to the target, in a thread of the pool.
+
+        :return: the number of bytes copied
+        """
+        raise NotImplementedError()
+
+    def _load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            _logger.info('S3: %s resuming after %s', self.label, state['start_after'])
+            return state['start_after']
+        return ''
+
+    def _save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        with self._lock:
+            state = dict(self.stats, start_after=self.watermark)
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.checkpoint)
+
+    def _accepted(self, start_after):
+        for name, size in self.iter_source(start_after):
+            if not self.accept or self.accept(name):
+                yield name, size
+
+    def missing(self, start_after=''):
+        """Yield the ``(name, size)`` of the source missing in the target."""
+        target = self.iter_target(start_after)
+        target_name = next(target, None)
+        for name, size in self._accepted(start_after):
+            self.stats['checked'] += 1
+            while target_name is not None and target_name < name:
+                target_name = next(target, None)
+            if target_name == name:
+                with self._lock:
+                    self.stats['skipped'] += 1
+                    if not self._pending:
+                        self.watermark = name
+                continue
+            yield name, size
+
+    def _copied(self, name, future):
+        with self._lock:
+            if future.exception() is not None:
+                self.stats['failed'] += 1
+                _logger.error('S3: %s was not able to copy %s: %s', self.label, name, future.exception())
+            else:
+                self.stats['copied'] += 1
+                self.stats['bytes'] += future.result()
+                self._done.add(name)
+            # everything up to the watermark is copied, failures stop it
+            while self._pending and self._pending[0] in self._done:
+                self.watermark = self._pending.popleft()
+                self._done.discard(self.watermark)
+
+    def report(self, started):
+        elapsed = max(time.time() - started, 0.001)
+        stats = self.stats
+        if not self.count_total:
+            _logger.info('S3: %s %d files checked, %d copied, %d failed (%.1f files/s, %.2f MB/s), now at %s',
+                         self.label, stats['checked'], stats['copied'], stats['failed'],
+                         stats['copied'] / elapsed, stats['bytes'] / elapsed / 1024 / 1024, self.watermark)
+            return
+        rate = stats['checked'] / elapsed
+        remaining = stats['total'] - stats['checked']
+        eta = remaining / rate if rate and remaining > 0 else 0
+        _logger.info('S3: %s %d/%d files checked, %d copied, %d failed '
+                     '(%.1f files/s, %.2f MB/s), ETA %ds', self.label,
+                     stats['checked'], stats['total'], stats['copied'], stats['failed'],
+                     stats['copied'] / elapsed, stats['bytes'] / elapsed / 1024 / 1024, eta)
+
+    def run(self):
+        """Run the copy and return its statistics, with its duration in
+        ``seconds`` and its throughput in ``bytes_per_second``."""
+        start_after = self.watermark = self._load_checkpoint()
+        if self.count_total:
+            self.stats['total'] = sum(1 for name in self._accepted(start_after))
+        started = last_report = last_checkpoint = time.time()
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for name, size in self.missing(start_after):
+                slots.acquire()
+                with self._lock:
+                    self._pending.append(name)
+                future = executor.submit(self.copy, name, size)
+                future.add_done_callback(lambda f, name=name: (self._copied(name, f), slots.release()))
+                now = time.time()
+                if now - last_report > self.report_interval:
+                    self.report(started)
+                    last_report = now
+                if now - last_checkpoint > self.checkpoint_interval:
+                    self._save_checkpoint()
+                    last_checkpoint = now
+        finally:
+            executor.shutdown(wait=True)
+            self._save_checkpoint()
+        self.report(started)
+        if not self.stats['failed'] and self.checkpoint and os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+        seconds = time.time() - started
+        return dict(self.stats, seconds=seconds, bytes_per_second=self.stats['bytes'] / max(seconds, 0.001))
+
+
+class FilestoreMigration(SortedTransfer):
+    """Copy a local filestore to the ``db_name/`` prefix of a bucket, sending
+    only the files missing there.
+
+    With ``accept``, only the paths it returns True for are copied, e.g. the
+    files of one bucket of a sharded storage.
+    """
+    label = 'migration'
+
+    def __init__(self, client, bucket_name, db_name, filestore, checkpoint=None, workers=16,
+                 transfer_config=None, report_interval=30, checkpoint_interval=10, accept=None, count_total=False):
+        super(FilestoreMigration, self).__init__(checkpoint, workers, report_interval, checkpoint_interval, accept,
+                                                 count_total)
+        self.client = client
+        self.bucket_name = bucket_name
+        self.db_name = db_name
+        self.filestore = filestore
+        self.transfer_config = transfer_config
+
+    def iter_source(self, start_after=''):
+        for path in walk_sorted(self.filestore, start_after):
+            yield path, None
+
+    def iter_target(self, start_after=''):
+        return iter_names(self.client, self.bucket_name, self.db_name + '/', start_after)
+
+    def copy(self, path, size):
+        full_path = os.path.join(self.filestore, path)
+        key = '%s/%s' % (self.db_name, path)
+        size = os.path.getsize(full_path)
+        if self.transfer_config and size >= self.transfer_config.multipart_threshold:
+            self.client.upload_file(full_path, self.bucket_name, key, Config=self.transfer_config)
+            check_upload(self.client, self.bucket_name, key, size)
+        else:
+            with open(full_path, 'rb') as f:
+                self.client.put_object(Bucket=self.bucket_name, Key=key, Body=f, ContentMD5=content_md5(f))
+        return size
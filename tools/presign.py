@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import collections
+import threading
+import time
+
+
+class PresignedUrls(object):
+    """Presigned GET urls of a bucket, reused within time windows.
+
+    Time is cut in windows of half the expiry: the url signed by the first
+    request of a window is handed out until the window ends, so the same
+    object gets the same url (and browsers can cache it), and that url is
+    still valid for at least half its expiry when it stops being handed out.
+
+    The codec of the objects, needed to sign the urls of compressed ones, is
+    kept as well: the content of a key only changes when it is stored again.
+    """
+
+    def __init__(self, client, bucket_name, maxsize=10000):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.maxsize = maxsize
+        self._urls = collections.OrderedDict()
+        self._codecs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def codec(self, key):
+        """Return the codec in the metadata of ``key`` (None if it is not
+        compressed), with a HEAD request the first time only."""
+        with self._lock:
+            if key in self._codecs:
+                codec = self._codecs.pop(key)
+                self._codecs[key] = codec
+                return codec
+        codec = self.client.head_object(Bucket=self.bucket_name, Key=key)['Metadata'].get('codec')
+        with self._lock:
+            self._codecs[key] = codec
+            while len(self._codecs) > self.maxsize:
+                self._codecs.popitem(last=False)
+        return codec
+
+    def forget(self, key):
+        """``key`` was stored again, maybe with another codec."""
+        with self._lock:
+            self._codecs.pop(key, None)
+
+    def get(self, key, expiry, **params):
+        """Return the url to GET ``key`` and the number of seconds it can still
+        be reused. ``params`` are extra GetObject parameters such as
+        ResponseContentType."""
+        window = max(expiry // 2, 1)
+        now = time.time()
+        slot = int(now // window)
+        cache_key = (key, expiry, tuple(sorted(params.items())))
+        with self._lock:
+            cached = self._urls.get(cache_key)
+        if cached is None or cached[0] != slot:
+            params = dict(params, Bucket=self.bucket_name, Key=key)
+            url = self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expiry)
+            cached = (slot, url)
+            with self._lock:
+                self._urls.pop(cache_key, None)
+                self._urls[cache_key] = cached
+                while len(self._urls) > self.maxsize:
+                    self._urls.popitem(last=False)
+        return cached[1], int((slot + 1) * window - now)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .breaker import CircuitBreaker
+from .metrics import metrics, request_usage
+from .presign import PresignedUrls
+from .stats import Counters
+from .ttlcache import TTLSet
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {
+    'max_pool_connections': 50,
+    'max_attempts': 3,
+    'connect_timeout': 5,
+    'read_timeout': 60,
+    'bucket_check_ttl': 300,
+    'known_keys_size': 100000,
+    'known_keys_ttl': 600,
+    'missing_keys_size': 10000,
+    'missing_keys_ttl': 60,
+    'breaker_failure_percent': 50,
+    'breaker_min_calls': 10,
+    'breaker_window': 30,
+    'breaker_open_seconds': 30,
+    'breaker_slow_call': 10,
+}
+
+# metric label of the S3 API operations
+OPERATIONS = {
+    'GetObject': 'get',
+    'PutObject': 'put',
+    'CreateMultipartUpload': 'put',
+    'UploadPart': 'put',
+    'CompleteMultipartUpload': 'put',
+    'AbortMultipartUpload': 'delete',
+    'HeadObject': 'head',
+    'HeadBucket': 'head',
+    'CopyObject': 'copy',
+    'DeleteObject': 'delete',
+    'DeleteObjects': 'delete',
+    'ListObjects': 'list',
+    'ListObjectsV2': 'list',
+    'ListMultipartUploads': 'list',
+}
+
+
+def _body_size(body):
+    try:
+        return len(body)
+    except TypeError:
+        # file objects of the uploads
+        try:
+            return os.fstat(body.fileno()).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            return 0
+
+
+class S3Connection(object):
+    """A pooled boto3 client for one storage url.
+
+    The bucket resource is built on top of the same client, so every object
+    handed out by this connection shares a single urllib3 connection pool
+    (idle sockets are kept alive and reused between requests).
+
+    ``known_keys`` remembers the keys recently seen in the bucket and
+    ``missing_keys`` the ones recently found missing, ``presigned_urls`` hands
+    out reusable presigned urls and ``stats`` counts the work done through the
+    connection.
+
+    Every request made by the client reports its outcome to ``breaker``: server
+    errors, connection errors and timeouts are failures. It is also counted in
+    the process :data:`metrics` and in the :data:`request_usage` of the thread.
+    """
+
+    def __init__(self, profile_name, bucket_name, options):
+        self.profile_name = profile_name
+        self.bucket_name = bucket_name
+        self.options = options
+        session = boto3.session.Session(profile_name=profile_name)
+        config = Config(
+            max_pool_connections=options['max_pool_connections'],
+            connect_timeout=options['connect_timeout'],
+            read_timeout=options['read_timeout'],
+            retries={'max_attempts': options['max_attempts']},
+            # the SHA256 of every request body (and multipart part) is signed
+            # and checked by S3, even over https
+            s3={'payload_signing_enabled': True},
+        )
+        # endpoint_url points to an S3 compatible service instead of AWS
+        self.resource = session.resource('s3', config=config, endpoint_url=options.get('endpoint_url'))
+        self.client = self.resource.meta.client
+        self.bucket = self.resource.Bucket(bucket_name)
+        self.known_keys = TTLSet(options['known_keys_size'], options['known_keys_ttl'])
+        self.missing_keys = TTLSet(options['missing_keys_size'], options['missing_keys_ttl'])
+        self.breaker = CircuitBreaker(
+            bucket_name,
+            failure_percent=options['breaker_failure_percent'],
+            min_calls=options['breaker_min_calls'],
+            window=options['breaker_window'],
+            open_seconds=options['breaker_open_seconds'],
+            slow_call=options['breaker_slow_call'],
+        )
+        self.client.meta.events.register('before-call.s3', self._before_call)
+        self.client.meta.events.register('needs-retry.s3', self._after_attempt)
+        self.presigned_urls = PresignedUrls(self.client, bucket_name)
+        self.stats = Counters()
+        self.checked_at = 0
+        self._lock = threading.Lock()
+
+    def _before_call(self, context=None, **kwargs):
+        if context is not None:
+            context['s3_started'] = time.time()
+
+    def _after_attempt(self, response=None, caught_exception=None, request_dict=None, operation=None, **kwargs):
+        # called after each attempt, retries included; returns None to leave
+        # the retry decision to botocore
+        request_dict = request_dict or {}
+        context = request_dict.get('context') or {}
+        now = time.time()
+        elapsed = now - context.get('s3_started', now)
+        context['s3_started'] = now
+        op = OPERATIONS.get(operation.name, operation.name) if operation is not None else 'unknown'
+        nbytes = 0
+        if caught_exception is not None:
+            self.breaker.record(False, elapsed)
+            outcome = 'connection_error'
+        elif response is not None:
+            status = response[0].status_code
+            self.breaker.record(status < 500, elapsed)
+            if status < 400:
+                outcome = 'ok'
+                if op == 'get':
+                    nbytes = response[1].get('ContentLength') or 0
+                    metrics.incr('s3_bytes_total', nbytes, direction='in')
+                elif op == 'put' and request_dict.get('body') is not None:
+                    nbytes = _body_size(request_dict['body'])
+                    metrics.incr('s3_bytes_total', nbytes, direction='out')
+            elif status == 404:
+                outcome = 'not_found'
+            elif status < 500:
+                outcome = 'client_error'
+            else:
+                outcome = 'server_error'
+        else:
+            return
+        metrics.incr('s3_requests_total', operation=op, outcome=outcome)
+        metrics.observe('s3_request_seconds', elapsed, operation=op)
+        request_usage.add(elapsed, nbytes)
+
+    def stored(self, key):
+        """Record that ``key`` exists in the bucket now."""
+        self.known_keys.add(key)
+        self.missing_keys.discard(key)
+        self.presigned_urls.forget(key)
+
+    def ensure_bucket(self, force=False):
+        """Check that the bucket exists (creating it if needed), at most once
+        every ``bucket_check_ttl`` seconds unless ``force`` is set."""
+        ttl = self.options['bucket_check_ttl']
+        if not force and self.checked_at and time.time() - self.checked_at < ttl:
+            return self.bucket
+        with self._lock:
+            if not force and self.checked_at and time.time() - self.checked_at < ttl:
+                return self.bucket
+            try:
+                self.client.head_bucket(Bucket=self.bucket_name)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchBucket'):
+                    # e.g. 403 when the credentials can use objects but not list the bucket
+                    _logger.warning('S3: head_bucket on %s failed with %s', self.bucket_name,
+                                    e.response['Error']['Code'])
+                else:
+                    self.client.create_bucket(Bucket=self.bucket_name)
+            self.checked_at = time.time()
+        return self.bucket
+
+
+class S3Registry(object):
+    """Process wide registry of :class:`S3Connection`, keyed by parsed storage url.
+
+    Connections are never shared with a forked child: the first access from a
+    new process drops everything inherited from the parent.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._connections = {}
+
+    def get(self, parsed_url, options=None):
+        """Return the connection for ``parsed_url``, the tuple returned by
+        ``ir.attachment._parse_storage_url``."""
+        self._check_fork()
+        connection = self._connections.get(parsed_url)
+        if connection is None:
+            with self._lock:
+                connection = self._connections.get(parsed_url)
+                if connection is None:
+                    scheme, access_type, profile_name, bucket_name, endpoint_url = parsed_url
+                    if access_type != 'profile':
+                        raise Exception("Unsupported S3 access type %r." % access_type)
+                    opts = dict(DEFAULT_OPTIONS, **(options or {}))
+                    if endpoint_url:
+                        # the endpoint of the url wins over s3_endpoint_url
+                        opts['endpoint_url'] = endpoint_url
+                    connection = S3Connection(profile_name, bucket_name, opts)
+                    self._connections[parsed_url] = connection
+        return connection
+
+    def reset(self):
+        with self._lock:
+            self._connections = {}
+
+
+s3_registry = S3Registry()
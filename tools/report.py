@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import csv
+import io
+import json
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+
+class AuditStatus(object):
+    """Outcome of the check of an attachment, without the overhead of a dict."""
+    __slots__ = ('name', 'fname', 's3_lost', 'error')
+    FIELDS = __slots__
+
+    def __init__(self, name, fname, s3_lost=False, error=None):
+        self.name = name
+        self.fname = fname
+        self.s3_lost = s3_lost
+        self.error = error
+
+    def as_dict(self):
+        status = {'name': self.name, 'fname': self.fname, 's3_lost': self.s3_lost}
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+
+def _encode(value):
+    if PY2 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class ReportWriter(object):
+    """Write records (dicts) to a report file as they come: json lines, or
+    csv with the ``fields`` columns when the path ends with .csv."""
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = list(fields)
+        self.format = 'csv' if path.endswith('.csv') else 'jsonl'
+        self.count = 0
+        self._file = None
+        self._csv = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        if self.format == 'csv':
+            self._file = open(self.path, 'wb') if PY2 else io.open(self.path, 'w', newline='', encoding='utf-8')
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(self.fields)
+        else:
+            self._file = open(self.path, 'wb') if PY2 else io.open(self.path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        if self._csv is not None:
+            self._csv.writerow([_encode(record.get(name)) for name in self.fields])
+        else:
+            self._file.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+from .diskcache import _makedirs
+
+_logger = logging.getLogger(__name__)
+
+# seconds before retrying a failed upload, doubled on each failure
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+
+
+class Staging(object):
+    """Files written locally and waiting to be uploaded, stored under their
+    store_fname. Each file has a ``.json`` sidecar with the metadata of its
+    object and the state of its upload retries.
+
+    Files are fsynced before being renamed in place, so a staged file survives
+    a crash of the server once ``put`` returned.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, fname):
+        return os.path.join(self.directory, *fname.split('/'))
+
+    def _write(self, path, data):
+        dirname = os.path.dirname(path)
+        _makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _read_state(self, fname):
+        try:
+            with open(self._path(fname) + '.json') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'metadata': {}, 'attempts': 0, 'next_try': 0}
+
+    def put(self, fname, data, metadata):
+        state = {'metadata': metadata, 'attempts': 0, 'next_try': 0}
+        self._write(self._path(fname) + '.json', json.dumps(state).encode('utf-8'))
+        self._write(self._path(fname), data)
+
+    def get_path(self, fname):
+        """Return the path of the staged file ``fname``, or None."""
+        path = self._path(fname)
+        return path if os.path.isfile(path) else None
+
+    def get(self, fname):
+        path = self.get_path(fname)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            # uploaded in between
+            return None
+
+    def metadata(self, fname):
+        return self._read_state(fname)['metadata']
+
+    def remove(self, fname):
+        for path in (self._path(fname), self._path(fname) + '.json'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def failed(self, fname):
+        """Postpone the next upload of ``fname`` with an exponential backoff."""
+        state = self._read_state(fname)
+        state['attempts'] += 1
+        delay = min(RETRY_DELAY * 2 ** (state['attempts'] - 1), MAX_RETRY_DELAY)
+        state['next_try'] = time.time() + delay
+        self._write(self._path(fname) + '.json', json.dumps(state).encode('utf-8'))
+        return state['attempts']
+
+    def pending(self):
+        """Yield ``(fname, mtime)`` for the staged files due for an upload."""
+        now = time.time()
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.') or name.endswith('.json'):
+                    continue
+                fname = os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, '/')
+                if self._read_state(fname)['next_try'] > now:
+                    continue
+                try:
+                    mtime = os.path.getmtime(os.path.join(root, name))
+                except OSError:
+                    continue
+                yield fname, mtime
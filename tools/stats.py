@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import collections
+import threading
+
+
+class Counters(object):
+    """Thread safe named counters."""
+
+    def __init__(self):
+        self._data = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._data[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._data)
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
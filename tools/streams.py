@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+CHUNK_SIZE = 256 * 1024
+
+
+def iter_body(body, chunk_size=CHUNK_SIZE):
+    """Iterate over a botocore ``StreamingBody`` by chunks, closing it at the end."""
+    try:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import os
+import tempfile
+
+from . import compression
+from .batch import transfer_object
+from .diskcache import _makedirs
+from .integrity import iter_verified
+from .listing import SHA_FNAME, iter_files
+from .migrate import SortedTransfer, walk_sorted
+from .streams import iter_body
+
+
+def _iter_files(client, bucket_name, prefix, start_after=''):
+    # the files of a database, not its trash or its checklist
+    listing = iter_files(client, bucket_name, prefix, start_after=prefix + start_after if start_after else None)
+    for key, size in listing:
+        name = key[len(prefix):]
+        if SHA_FNAME.match(name):
+            yield name, size
+
+
+class BucketToFilestore(SortedTransfer):
+    """Download the files of the ``db_name/`` prefix of a bucket missing in a
+    local filestore, e.g. to restore it or to leave S3.
+
+    The objects are decompressed and checked against their SHA1 on the way,
+    and a file only appears in the filestore once complete.
+    """
+    label = 'download'
+
+    def __init__(self, client, bucket_name, db_name, filestore, checkpoint=None, workers=16,
+                 report_interval=30, checkpoint_interval=10, accept=None, count_total=False):
+        super(BucketToFilestore, self).__init__(checkpoint, workers, report_interval, checkpoint_interval, accept,
+                                                count_total)
+        self.client = client
+        self.bucket_name = bucket_name
+        self.prefix = db_name + '/'
+        self.filestore = filestore
+
+    def iter_source(self, start_after=''):
+        return _iter_files(self.client, self.bucket_name, self.prefix, start_after)
+
+    def iter_target(self, start_after=''):
+        return walk_sorted(self.filestore, start_after)
+
+    def copy(self, name, size):
+        response = self.client.get_object(Bucket=self.bucket_name, Key=self.prefix + name)
+        chunks = iter_body(response['Body'])
+        codec = response.get('Metadata', {}).get('codec')
+        if codec:
+            chunks = compression.iter_decompress(chunks, codec)
+        directory = os.path.dirname(os.path.join(self.filestore, name))
+        _makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter_verified(chunks, name):
+                    f.write(chunk)
+            os.rename(tmp_path, os.path.join(self.filestore, name))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            response['Body'].close()
+        return response['ContentLength']
+
+
+class BucketToBucket(SortedTransfer):
+    """Copy the files of the ``source_db/`` prefix of a bucket missing under
+    the ``target_db/`` prefix of another one (or of the same one, for a
+    renamed or duplicated database), server side when ``server_side``."""
+    label = 'replication'
+
+    def __init__(self, source_client, source_bucket, source_db, target_client, target_bucket, target_db,
+                 server_side=True, checkpoint=None, workers=16, report_interval=30, checkpoint_interval=10,
+                 accept=None, count_total=False):
+        super(BucketToBucket, self).__init__(checkpoint, workers, report_interval, checkpoint_interval, accept,
+                                             count_total)
+        self.source_client = source_client
+        self.source_bucket = source_bucket
+        self.source_prefix = source_db + '/'
+        self.target_client = target_client
+        self.target_bucket = target_bucket
+        self.target_prefix = target_db + '/'
+        self.server_side = server_side
+
+    def iter_source(self, start_after=''):
+        return _iter_files(self.source_client, self.source_bucket, self.source_prefix, start_after)
+
+    def iter_target(self, start_after=''):
+        for name, size in _iter_files(self.target_client, self.target_bucket, self.target_prefix, start_after):
+            yield name
+
+    def copy(self, name, size):
+        copied = transfer_object(self.source_client, self.source_bucket, self.source_prefix + name,
+                                 self.target_client, self.target_bucket, self.target_prefix + name, self.server_side)
+        return size if copied is None else copied
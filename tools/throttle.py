@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import threading
+import time
+
+
+class ByteBudget(object):
+    """Bounds the number of bytes in flight between threads: ``acquire(n)``
+    blocks until ``n`` bytes fit in the budget. A request bigger than the
+    whole budget is let through alone."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.max_bytes)
+        with self._cond:
+            while self.used and self.used + size > self.max_bytes:
+                self._cond.wait()
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class RateLimiter(object):
+    """Token bucket shared between threads: ``consume(n)`` sleeps as long as
+    needed to keep under ``rate`` units (e.g. bytes) per second, with bursts
+    of ``burst`` units (a second worth by default). A consumption bigger than
+    the bucket is let through and paid back by the next ones."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttle(self, chunks):
+        """Pass ``chunks`` through at the rate of the limiter."""
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import collections
+import threading
+import time
+
+
+class TTLSet(object):
+    """Thread safe set of keys expiring after ``ttl`` seconds, holding at most
+    ``maxsize`` keys (the oldest ones are dropped first)."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = time.time() + self.ttl
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __contains__(self, key):
+        expires = self._data.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            self.discard(key)
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()